@@ -19,6 +19,15 @@ async def root(request: Request):
 async def ping(_: Request):
     return json_response({"message": "pong"})
 
+@routes.get("/stats")
+async def stats(_: Request):
+    return json_response({
+        **BotContainer.tg_bot().stats(),
+        'search_cache': BotContainer.tavily_service().stats(),
+        'blobs': BotContainer.blob_store().stats(),
+        'tts': BotContainer.voice_service().stats(),
+    })
+
 @routes.get("/set_webhook")
 async def set_webhook(_: Request):
     res = await BotContainer.tg_bot().set_webhook()
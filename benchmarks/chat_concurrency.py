@@ -0,0 +1,76 @@
+"""
+Turn throughput against the number of concurrently active chats, with a fake model latency.
+
+Compares the per chat `KeyedLock` with a single process-wide lock, which is how turns were serialized before.
+
+    python benchmarks/chat_concurrency.py [--turns 4] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from chat.blob_store import BlobStore
+from chat.history import HistoryManager
+from chat.repository import Chat
+from utils.keyed_lock import KeyedLock
+
+class FakeSession():
+    def __init__(self) -> None:
+        self._curated_history = []
+
+class FakeProcessor():
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    async def process_response(self, session, messages, chat_id):
+        await asyncio.sleep(self.latency)
+        yield 'ok'
+
+class GlobalLock(KeyedLock[int]):
+    """Hands out the same lock for every chat, like the class level semaphore used to."""
+
+    @asynccontextmanager
+    async def __call__(self, key: int):
+        async with super().__call__(0):
+            yield
+
+async def run(chats: int, turns: int, latency: float, locks: KeyedLock[int], blobs: BlobStore) -> float:
+    processor = FakeProcessor(latency)
+    history = HistoryManager()
+
+    async def talk(chat: Chat):
+        for _ in range(turns):
+            async for _ in chat.send_message_async(['hello']):
+                pass
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        talk(Chat(id=i, session=FakeSession(), processor=processor, history=history, blobs=blobs, locks=locks))  # type: ignore
+        for i in range(chats)
+    ))
+    return chats * turns / (time.perf_counter() - started)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=4, help='turns per chat')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake model latency in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir:
+        blobs = BlobStore(path=dir)
+        print(f"{args.turns} turns per chat, {args.latency * 1000:.0f} ms fake model latency\n")
+        print(f"{'chats':>6} {'global lock':>14} {'per chat lock':>16}")
+        for chats in (1, 4, 16, 64):
+            before = await run(chats, args.turns, args.latency, GlobalLock(), blobs)
+            after = await run(chats, args.turns, args.latency, KeyedLock(), blobs)
+            print(f"{chats:>6} {before:>10.1f} t/s {after:>12.1f} t/s")
+
+if __name__ == '__main__':
+    asyncio.run(main())
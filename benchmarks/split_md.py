@@ -0,0 +1,105 @@
+"""
+Markdown splitting micro-benchmarks, the single pass `split_md` and `MarkdownSplitter` against the
+previous implementation, which rescanned the text for code blocks at every paragraph break.
+
+    python benchmarks/split_md.py [--repeat 5]
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from os import path
+from typing import Callable
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from utils.markdown import MarkdownSplitter, split_md
+
+def __is_inside_code_block__(text: str, index: int):
+    code_blocks = re.finditer(r'(^|\s|\\n)```.*?[\s\S]*?```(\\n|\s|$)', text)
+
+    for code_block in code_blocks:
+        if code_block.start() < index < code_block.end():
+            return True
+        elif index < code_block.start():
+            break
+
+    return False
+
+def __find_split_index__(markdown: str, max_size: int) -> int:
+    sections = re.finditer(r'(\n\n+)', markdown)
+    indices = [0]
+    for section in sections:
+        if section.start() > max_size:
+            break
+        if not __is_inside_code_block__(markdown, section.start()):
+            indices.append(section.start())
+    return max(indices)
+
+def legacy_split_md(markdown: str, max_slice_size: int = 4000):
+    if len(markdown) <= max_slice_size:
+        return [markdown]
+
+    chunks: list[str] = []
+    while len(markdown) > max_slice_size:
+        split_index = __find_split_index__(markdown, max_slice_size)
+        if split_index == 0:
+            break
+        chunks.append(markdown[:split_index].strip())
+        markdown = markdown[split_index:].strip()
+
+    chunks.append(markdown.strip())
+
+    return chunks
+
+def document(size: int, seed: int = 0) -> str:
+    """A reply-like markdown document, paragraphs mixed with fenced code blocks."""
+    rng = random.Random(seed)
+    words = ['gemini', 'telegram', 'chat', 'reply', '**bold**', '_italic_', '`code`', 'markdown', 'split', 'stream']
+    blocks: list[str] = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.2:
+            lines = [' '.join(rng.choices(words, k=rng.randint(3, 10))) for _ in range(rng.randint(3, 15))]
+            block = '```python\n' + '\n'.join(lines) + '\n```'
+        else:
+            block = ' '.join(rng.choices(words, k=rng.randint(20, 120)))
+        blocks.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(blocks)[:size]
+
+def best_of(repeat: int, fn: Callable[[], object]) -> float:
+    timings: list[float] = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def stream(split: Callable[[str], list[str]], text: str, delta: int):
+    for end in range(delta, len(text) + delta, delta):
+        split(text[:end])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best one is reported')
+    args = parser.parse_args()
+
+    for kb in (50, 100, 200, 500):
+        text = document(kb * 1024)
+        assert len(split_md(text)) > 1
+        before = best_of(args.repeat, lambda: legacy_split_md(text))
+        after = best_of(args.repeat, lambda: split_md(text))
+        print(f"split_md  {kb:>3} KB: {before * 1000:8.2f} ms -> {after * 1000:6.2f} ms")
+
+    # the legacy streaming runs take seconds, they are measured once
+    for kb in (50, 100):
+        text = document(kb * 1024)
+        before = best_of(1, lambda: stream(legacy_split_md, text, 200))
+        after = best_of(args.repeat, lambda: stream(MarkdownSplitter().update, text, 200))
+        print(f"streaming {kb:>3} KB in 200 char deltas: {before:6.2f} s -> {after * 1000:6.1f} ms")
+
+if __name__ == '__main__':
+    main()
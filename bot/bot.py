@@ -5,24 +5,35 @@ from aiogram.enums import ParseMode
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp.web import Application
 from httpx import URL
+from os import getenv
 
 from bot.routers import commands, prompts
+from bot.middlewares.admission import AdmissionMiddleware
+from bot.middlewares.dedup import UpdateDedupMiddleware
 from bot.middlewares.wake_me_up import WakeMeUpMiddleware
+from bot.webhook import QueuedRequestHandler
 from common.types.enums import BotEventMethods
 from chat.repository import ChatRepo
+from chat.services.transcription import TranscriptionService
 from chat.services.voice import VoiceService
 
 logging: Logger = getLogger(__name__)
 
+WEBHOOK_HANDLE_IN_BACKGROUND = getenv('WEBHOOK_HANDLE_IN_BACKGROUND', '1') == '1'
+
 class TgBot(object):
     bot: Bot
     dispatcher: Dispatcher
     chat_repo: ChatRepo
     voice_service: VoiceService
+    transcriber: TranscriptionService
     webhook_host: str
     webhook_path: str
+    webhook_handler: SimpleRequestHandler
     secret: str
     method: BotEventMethods
+    dedup: UpdateDedupMiddleware
+    admission: AdmissionMiddleware
 
     routers = [
         commands.command_router,
@@ -35,28 +46,56 @@ class TgBot(object):
         self.dispatcher.startup.register(hacky.startup)
         self.dispatcher.shutdown.register(hacky.shutdown)
 
-    def __init__(self, token: str, chat_repo: ChatRepo, voice_service: VoiceService, webhook_host: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2, webhook_secret: str = ''):
+    def __setup_admission__(self):
+        # registered after the wake me up middleware, the bot stays awake while messages are queued
+        self.admission = AdmissionMiddleware()
+        self.dispatcher.message.middleware.register(self.admission)
+
+    def __setup_dedup__(self):
+        # outer update middleware, so that the duplicates are dropped before anything is downloaded
+        self.dedup = UpdateDedupMiddleware()
+        self.dispatcher.update.outer_middleware.register(self.dedup)
+        self.dispatcher.startup.register(self.dedup.startup)
+        self.dispatcher.shutdown.register(self.dedup.shutdown)
+
+    def __init__(self, token: str, chat_repo: ChatRepo, voice_service: VoiceService, transcriber: TranscriptionService, webhook_host: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2, webhook_secret: str = ''):
         self.bot = Bot(token, default=DefaultBotProperties(parse_mode=parse_mode))
         self.dispatcher = Dispatcher()
         self.dispatcher.include_routers(*self.routers)
         self.chat_repo = chat_repo
         self.voice_service = voice_service
+        self.transcriber = transcriber
         self.webhook_host = webhook_host
         self.secret = webhook_secret
         self.method = BotEventMethods.unknown
+        self.__setup_dedup__()
         self.__setup_wake_me_up__()
+        self.__setup_admission__()
+        # persist the chats whenever the bot stops listening, i.e. on sleep or shutdown
+        self.dispatcher.shutdown.register(self.chat_repo.flush)
 
     def register_webhook_handler(self, app: Application, path: str):
         # Create an instance of request handler,
         # aiogram has few implementations for different cases of usage
         # In this example we use SimpleRequestHandler which is designed to handle simple cases
-        webhook_requests_handler = SimpleRequestHandler(
-            dispatcher=self.dispatcher,
-            bot=self.bot,
-            secret_token=self.secret,
-            repo=self.chat_repo,
-            handle_in_background=False
-        )
+        if WEBHOOK_HANDLE_IN_BACKGROUND:
+            # ack the updates right away and handle them with a bounded pool of workers
+            webhook_requests_handler = QueuedRequestHandler(
+                dispatcher=self.dispatcher,
+                bot=self.bot,
+                secret_token=self.secret,
+                repo=self.chat_repo,
+                transcriber=self.transcriber
+            )
+        else:
+            webhook_requests_handler = SimpleRequestHandler(
+                dispatcher=self.dispatcher,
+                bot=self.bot,
+                secret_token=self.secret,
+                repo=self.chat_repo,
+                transcriber=self.transcriber,
+                handle_in_background=False
+            )
         # Register webhook handler on application
         webhook_requests_handler.register(app, path=path)
 
@@ -64,6 +103,15 @@ class TgBot(object):
         setup_application(app, self.dispatcher, bot=self.bot)
 
         self.webhook_path = path
+        self.webhook_handler = webhook_requests_handler
+
+    def stats(self):
+        return {
+            'method': self.method.name,
+            'duplicate_updates': self.dedup.dropped,
+            'messages': self.admission.stats(),
+            'webhook': self.webhook_handler.stats() if isinstance(self.webhook_handler, QueuedRequestHandler) else None,
+        }
 
     async def set_webhook(self, drop_pending_updates = False):
         if not self.webhook_host or self.webhook_host.strip() == '':
@@ -87,7 +135,7 @@ class TgBot(object):
     
     def start_polling(self):
         self.method = BotEventMethods.polling
-        return self.dispatcher.start_polling(self.bot, handle_signals=False, repo=self.chat_repo, voice_service=self.voice_service)
+        return self.dispatcher.start_polling(self.bot, handle_signals=False, repo=self.chat_repo, voice_service=self.voice_service, transcriber=self.transcriber)
     
     def stop_polling(self):
         self.method = BotEventMethods.unknown
@@ -0,0 +1,86 @@
+from logging import Logger, getLogger
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+from aiogram.utils.markdown import italic
+from os import getenv
+
+from chat.repository import ChatRepo
+from common.types.exceptions import ServiceOverloadedException
+from utils.fair_queue import FairQueue
+
+logging: Logger = getLogger(__name__)
+
+MSG_HANDLING_CONCURRENCY = int(getenv('MSG_HANDLING_CONCURRENCY', '20'))
+MSG_PER_CHAT_CONCURRENCY = int(getenv('MSG_PER_CHAT_CONCURRENCY', '2'))
+MSG_QUEUE_SIZE = int(getenv('MSG_QUEUE_SIZE', '100'))
+MSG_PER_CHAT_QUEUE_SIZE = int(getenv('MSG_PER_CHAT_QUEUE_SIZE', '10'))
+MSG_PRIORITY_SLOTS = int(getenv('MSG_PRIORITY_SLOTS', '2'))
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Schedules the message handling fairly across the chats.
+
+    Every chat gets its turn in a round robin order and can't use more than its quota of the
+    concurrent slots, commands are served in a priority lane. When too many messages are waiting
+    the message is rejected, rather than being queued forever.
+
+    A message of a chat whose next turn is still collecting messages takes a side lane, it is merged
+    into that turn, which already holds one of the slots of the chat. Otherwise the messages sent
+    while a turn is running would wait here behind the per chat quota and miss the coalescing.
+    The side lane doesn't wait, but it is bounded to `MSG_PER_CHAT_QUEUE_SIZE` messages of a chat,
+    the ones above it are queued as usual.
+    """
+    queue: FairQueue[int]
+    merging: dict[int, int]
+
+    def __init__(self):
+        super(AdmissionMiddleware, self).__init__()
+        self.queue = FairQueue(
+            concurrency=MSG_HANDLING_CONCURRENCY,
+            per_key_limit=MSG_PER_CHAT_CONCURRENCY,
+            max_queued=MSG_QUEUE_SIZE,
+            max_queued_per_key=MSG_PER_CHAT_QUEUE_SIZE,
+            priority_slots=MSG_PRIORITY_SLOTS
+        )
+        self.merging = {}
+        logging.info('Message handling concurrency set to %d, %d per chat', MSG_HANDLING_CONCURRENCY, MSG_PER_CHAT_CONCURRENCY)
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        # commands are cheap, they don't wait behind the prompts
+        priority = event.text is not None and event.text.startswith('/')
+        repo: ChatRepo | None = data.get('repo')
+        merging = self.merging.get(event.chat.id, 0)
+        if not priority and repo is not None and repo.collecting(event.chat.id) and merging < MSG_PER_CHAT_QUEUE_SIZE:
+            # the pending turn might get sealed before this message reaches it, the message then
+            # runs its own turn without a slot, which is still serialized by the lock of the chat
+            self.merging[event.chat.id] = merging + 1
+            try:
+                return await handler(event, data)
+            finally:
+                if (merging := self.merging[event.chat.id] - 1) == 0:
+                    del self.merging[event.chat.id]
+                else:
+                    self.merging[event.chat.id] = merging
+
+        try:
+            await self.queue.acquire(event.chat.id, priority=priority)
+        except ServiceOverloadedException:
+            logging.warning(f'Rejecting message {event.message_id} of chat {event.chat.id}, {self.queue.stats()}')
+            await event.reply(italic('Too many messages right now, please try again in a bit.'))
+            return None
+
+        try:
+            return await handler(event, data)
+        finally:
+            self.queue.release(event.chat.id)
+
+    def stats(self):
+        return {
+            **self.queue.stats(),
+            'merging': sum(self.merging.values()),
+        }
@@ -0,0 +1,73 @@
+import asyncio
+import json
+from logging import Logger, getLogger
+from os import getenv, makedirs, path
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from utils.seen_index import SeenIndex
+
+logging: Logger = getLogger(__name__)
+
+UPDATE_DEDUP_CAPACITY = int(getenv('UPDATE_DEDUP_CAPACITY', '10000'))
+UPDATE_DEDUP_TTL = float(getenv('UPDATE_DEDUP_TTL', '86400'))
+UPDATE_DEDUP_STORE = getenv('UPDATE_DEDUP_STORE', '')
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """Drops the updates which were already handled.
+
+    Telegram delivers an update again when the webhook times out, and switching between webhook and
+    polling can deliver an update twice. The recently seen update ids are optionally persisted in a
+    file, so that the duplicates are detected across restarts as well.
+    """
+    seen: SeenIndex
+    store_path: str
+    dropped: int
+
+    def __init__(self, store_path: str = UPDATE_DEDUP_STORE):
+        super(UpdateDedupMiddleware, self).__init__()
+        self.seen = SeenIndex(capacity=UPDATE_DEDUP_CAPACITY, ttl=UPDATE_DEDUP_TTL)
+        self.store_path = store_path
+        self.dropped = 0
+
+    def __load__(self):
+        with open(self.store_path) as file:
+            return json.load(file)
+
+    def __save__(self, items: list[tuple[int, float]]):
+        if (dir := path.dirname(self.store_path)) != '':
+            makedirs(dir, exist_ok=True)
+        with open(self.store_path, 'w') as file:
+            json.dump(items, file)
+
+    async def startup(self):
+        if not self.store_path or not path.exists(self.store_path):
+            return
+        try:
+            items = await asyncio.to_thread(self.__load__)
+            for id, seen_at in sorted(items, key=lambda item: item[1]):
+                self.seen.add(id, seen_at)
+            logging.debug(f'Loaded {len(items)} seen update ids')
+        except Exception as e:
+            logging.warning(f'Failed to load seen update ids: {e}')
+
+    async def shutdown(self):
+        if not self.store_path:
+            return
+        try:
+            await asyncio.to_thread(self.__save__, self.seen.items())
+        except Exception as e:
+            logging.warning(f'Failed to save seen update ids: {e}')
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not self.seen.add(event.update_id):
+            self.dropped += 1
+            logging.info(f'Dropping duplicate update {event.update_id}')
+            return None
+        return await handler(event, data)
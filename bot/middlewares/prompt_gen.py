@@ -10,7 +10,8 @@ from PIL.Image import Image, open
 import pypdfium2 as pdfium
 
 from common.types.exceptions import FileSizeTooBigException, UnsupportedFileFormatException
-from chat.services.voice import VoiceService
+from chat.services.transcription import TranscriptionService
+from common.constants.keywords import VOICE_TRANSCRIPT
 from chat.prompts.templates import build_msg_metadata_prompt
 from utils.docreader import get_docx_text
 
@@ -39,20 +40,30 @@ class PromptGenMiddleware(BaseMiddleware):
         else:
             return img.convert('RGB')
         
-    async def __gen_voice_prompt__(self, voice: Union[Audio, Voice], bot: Bot) -> Part:
+    async def __gen_voice_prompt__(self, voice: Union[Audio, Voice], bot: Bot, transcriber: TranscriptionService | None = None) -> list[Part]:
         binfile = await bot.download(voice.file_id, BytesIO())
         if binfile is None:
             raise UnsupportedFileFormatException("Voice", voice.file_id)
         elif voice.mime_type is None:
             raise UnsupportedFileFormatException("Voice", voice.file_id)
 
-        return Part(
+        audio = Part(
             inline_data=Blob(
                 mime_type=voice.mime_type,
                 data=binfile.read()
             )
         )
-        
+        if transcriber is None or not transcriber.enabled or audio.inline_data is None:
+            return [audio]
+
+        # a transcript is much cheaper to resend with the history than the audio
+        transcript = await transcriber.transcribe(audio.inline_data)
+        if transcript is None:
+            return [audio]
+        prompt = Part(text=f"{VOICE_TRANSCRIPT}: {transcript}")
+        # the audio is dropped from the history once the turn is answered
+        return [prompt, audio] if transcriber.keep_audio else [prompt]
+
     async def __gen_pdf_prompt__(self, document: Document, bot: Bot):
         # if greater than 20 MB raise exception
         if document.file_size and document.file_size > 20000000:
@@ -95,7 +106,7 @@ class PromptGenMiddleware(BaseMiddleware):
         text += get_docx_text(binfile)
         return text
 
-    async def __msg_to_prompt__(self, msg: Message, exclude_caption: bool = False, exclude_metadata: bool = False):
+    async def __msg_to_prompt__(self, msg: Message, exclude_caption: bool = False, exclude_metadata: bool = False, transcriber: TranscriptionService | None = None):
         prompts: list[PartUnionDict] = []
         meta_dict: dict[str, str] = {
             'timestamp': str(msg.date),
@@ -113,9 +124,9 @@ class PromptGenMiddleware(BaseMiddleware):
             
             prompts.append(await self.__gen_img_prompt__(msg.photo, bot=msg.bot))
         elif (msg.voice):
-            prompts.append(await self.__gen_voice_prompt__(msg.voice, bot=msg.bot))
+            prompts.extend(await self.__gen_voice_prompt__(msg.voice, bot=msg.bot, transcriber=transcriber))
         elif (msg.audio):
-            prompts.append(await self.__gen_voice_prompt__(msg.audio, bot=msg.bot))
+            prompts.extend(await self.__gen_voice_prompt__(msg.audio, bot=msg.bot, transcriber=transcriber))
         elif (msg.sticker):
             if (msg.sticker.thumbnail):
                 prompts.append(await self.__gen_img_prompt__([msg.sticker.thumbnail], bot=msg.bot))
@@ -151,12 +162,13 @@ class PromptGenMiddleware(BaseMiddleware):
             prompts: list[Union[str, Image]] = []
             tasks: list[asyncio.Task] = []
 
-            tasks.append(asyncio.create_task(self.__msg_to_prompt__(event)))
+            transcriber: TranscriptionService | None = data.get('transcriber')
+            tasks.append(asyncio.create_task(self.__msg_to_prompt__(event, transcriber=transcriber)))
             tasks[-1].add_done_callback(lambda p: prompts.extend(p.result()))
 
             reply_of = event.reply_to_message
             if (reply_of):
-                tasks.append(asyncio.create_task(self.__msg_to_prompt__(reply_of, exclude_caption=True, exclude_metadata=True)))
+                tasks.append(asyncio.create_task(self.__msg_to_prompt__(reply_of, exclude_caption=True, exclude_metadata=True, transcriber=transcriber)))
                 tasks[-1].add_done_callback(lambda p: prompts.extend(p.result()))
 
             await asyncio.gather(*tasks)
@@ -1,17 +1,16 @@
 import asyncio
+import time
 from logging import Logger, getLogger
 from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import Message
-from aiohttp.web import Response
 from os import getenv
 
 from common.types.enums import BotEventMethods
-from utils.aiotimer import Timer
+from utils.aiotimer import Deadline, scheduler
 
 logging: Logger = getLogger(__name__)
 
-MSG_HANDLING_CONCURRENCY = int(getenv('MSG_HANDLING_CONCURRENCY', '20'))
 INACTIVITY_SLEEP_DELAY = int(getenv('INACTIVITY_SLEEP_DELAY', '-1'))
 
 class WakeMeUpMiddleware(BaseMiddleware):
@@ -19,11 +18,12 @@ class WakeMeUpMiddleware(BaseMiddleware):
         
         As it is not possible to use webhooks with polling and webhooks gives incosistent results.
     """
-    timer: Timer | None
+    sleep_deadline: Deadline | None = None
     bot: Any
+    wake_task: asyncio.Task | None = None
     bot_sleep_sem = asyncio.BoundedSemaphore()
-    bot_activity_sem = asyncio.BoundedSemaphore(MSG_HANDLING_CONCURRENCY)
-    timer_create_sem = asyncio.BoundedSemaphore()
+    # number of messages being handled right now, the bot is idle when it is 0
+    in_flight = 0
     sleep_enabled = False
 
     def __init__(self, tg_bot: Any):
@@ -32,36 +32,22 @@ class WakeMeUpMiddleware(BaseMiddleware):
         self.sleep_enabled = INACTIVITY_SLEEP_DELAY > 0
         if self.sleep_enabled:
             logging.info('Inactivity sleep timer set to %d seconds', INACTIVITY_SLEEP_DELAY)
-        logging.info('Message handling concurrency set to %d', MSG_HANDLING_CONCURRENCY)
 
     def __awake(self) -> bool:
         return self.bot.method == BotEventMethods.polling
 
-    async def create_sleep_timer(self, delay: int = INACTIVITY_SLEEP_DELAY):
-        while self.sleep_enabled:
-            try:
-                async with self.timer_create_sem:
-                    # timer is scheduled here
-                    self.timer = Timer(delay, callback=WakeMeUpMiddleware.goto_sleep, callback_args=[self])
-
-                # wait until the callback has been executed
-                await self.timer.wait()
-            except asyncio.CancelledError:
-                # get clock time
-                logging.debug('Bot timer cancelled')
-                pass
-
-            if not self.__awake():
-                break
+    def schedule_sleep(self, delay: int = INACTIVITY_SLEEP_DELAY):
+        if self.sleep_enabled:
+            self.sleep_deadline = scheduler.reschedule(self.sleep_deadline, delay, self.goto_sleep)
 
-    def cancel_sleep_timer(self):
-        if self.sleep_enabled and self.timer:
-            self.timer.cancel()
-            self.timer = None
+    def cancel_sleep(self):
+        scheduler.cancel(self.sleep_deadline)
+        self.sleep_deadline = None
 
-    async def goto_sleep(self):
+    async def goto_sleep(self, force: bool = False):
         async with self.bot_sleep_sem:
-            if self.__awake():
+            # a message might have arrived right when the deadline was due
+            if self.__awake() and (force or self.in_flight == 0):
                 logging.info('Bot going to sleep...')
                 await self.bot.stop_polling()
                 await self.bot.set_webhook()
@@ -72,7 +58,8 @@ class WakeMeUpMiddleware(BaseMiddleware):
                 logging.info('Bot waking up...')
                 await self.bot.delete_webhook()
                 asyncio.create_task(self.bot.start_polling())
-                asyncio.create_task(self.create_sleep_timer())
+                if self.in_flight == 0:
+                    self.schedule_sleep()
 
     async def startup(self):
         if not self.__awake():
@@ -82,8 +69,8 @@ class WakeMeUpMiddleware(BaseMiddleware):
     async def shutdown(self):
         if self.__awake():
             logging.debug('HackyMiddleware closing...')
-            await self.goto_sleep()
-            self.cancel_sleep_timer()
+            await self.goto_sleep(force=True)
+            self.cancel_sleep()
 
     async def __call__(
         self,
@@ -91,19 +78,24 @@ class WakeMeUpMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any]
     ) -> Any:
+        # the bot can't sleep while there is any activity
+        self.in_flight += 1
+        self.cancel_sleep()
         try:
-            # acquire lock to hold the sleep timer
-            if self.sleep_enabled and self.bot_activity_sem._value == MSG_HANDLING_CONCURRENCY:
-                await self.timer_create_sem.acquire()
-                self.cancel_sleep_timer()
+            if self.__awake():
+                return await handler(event, data)
 
-            async with self.bot_activity_sem:
-                if not self.__awake():
-                    await self.wake_up()
-                    return Response(status=400, text='Bot is asleep')
-                else:
-                    return await handler(event, data)
+            # start polling in background, and handle the update which woke the bot up right away
+            # the updates received by both webhook and polling during the handover are dropped by the dedup middleware
+            woke_at = time.monotonic()
+            if self.wake_task is None or self.wake_task.done():
+                self.wake_task = asyncio.create_task(self.wake_up())
+            try:
+                return await handler(event, data)
+            finally:
+                logging.info('Cold start reply latency: %.2fs since the message was sent, %.2fs since the wake up',
+                             time.time() - event.date.timestamp(), time.monotonic() - woke_at)
         finally:
-            # release lock if there is no more activity
-            if self.sleep_enabled and self.bot_activity_sem._value == MSG_HANDLING_CONCURRENCY:
-                self.timer_create_sem.release()
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.schedule_sleep()
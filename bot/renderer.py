@@ -0,0 +1,151 @@
+import asyncio
+from logging import Logger, getLogger
+from os import getenv
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+from md2tgmd import escape
+
+from utils.markdown import MarkdownSplitter
+
+logging: Logger = getLogger(__name__)
+
+# Telegram allows about 1 message per second in a private chat and 20 messages per minute in a group
+REPLY_EDIT_INTERVAL = float(getenv('REPLY_EDIT_INTERVAL', '1'))
+GROUP_REPLY_EDIT_INTERVAL = float(getenv('GROUP_REPLY_EDIT_INTERVAL', '3'))
+FINAL_FLUSH_RETRIES = 3
+
+class ReplyRenderer():
+    """Renders a streamed text response as Telegram replies.
+
+    Only the latest text is kept, and it is flushed at most once per edit interval of the chat.
+    `close()` always flushes the final text.
+    """
+    __reply_to: Message
+    __replies: list[Message]
+    __rendered: list[int | None]
+    __splitter: MarkdownSplitter
+    __escaped: dict[str, tuple[str, int]]
+    __interval: float
+    __text: str
+    __flushed_text: str
+    __wakeup: asyncio.Event
+    __task: asyncio.Task | None
+    __error: TelegramBadRequest | None
+    __closed: bool
+
+    def __init__(self, reply_to: Message, placeholder: Message | None = None):
+        self.__reply_to = reply_to
+        # the placeholder is reused as the first reply, its content is always replaced
+        self.__replies = [placeholder] if placeholder else []
+        self.__rendered = [None] if placeholder else []
+        self.__splitter = MarkdownSplitter()
+        self.__escaped = {}
+        self.__interval = REPLY_EDIT_INTERVAL if reply_to.chat.type == 'private' else GROUP_REPLY_EDIT_INTERVAL
+        self.__text = ''
+        self.__flushed_text = ''
+        self.__wakeup = asyncio.Event()
+        self.__task = None
+        self.__error = None
+        self.__closed = False
+
+    @property
+    def replies(self):
+        return self.__replies
+
+    def __escape__(self, chunk: str) -> tuple[str, int]:
+        # the chunks which are not growing anymore are escaped only once
+        cached = self.__escaped.get(chunk)
+        if cached is None:
+            # escape() converts Markdown to Telegram specific Markdown v2 format
+            escaped = escape(chunk)
+            cached = self.__escaped[chunk] = (escaped, hash(escaped.strip()))
+        return cached
+
+    async def __flush__(self):
+        text = self.__text
+        if text == self.__flushed_text or text.strip() == '':
+            return
+
+        # Split the response into chunks, only the tail is split again as the response grows
+        chunks = self.__splitter.update(text)
+        for i, chunk in enumerate(chunks):
+            escaped, digest = self.__escape__(chunk)
+
+            if i < len(self.__replies):
+                if self.__rendered[i] != digest:
+                    # Update the reply chunks if there are changes
+                    await self.__replies[i].edit_text(text=escaped)
+                    self.__rendered[i] = digest
+            else:
+                prev_msg = self.__replies[i - 1] if i > 0 else self.__reply_to
+                # Send the chunk as a new reply
+                self.__replies.append(await prev_msg.reply(text=escaped))
+                self.__rendered.append(digest)
+
+        # forget the previous versions of the growing chunk
+        self.__escaped = {chunk: self.__escaped[chunk] for chunk in chunks}
+        self.__flushed_text = text
+
+    async def __run__(self):
+        while True:
+            await self.__wakeup.wait()
+            self.__wakeup.clear()
+            if self.__closed:
+                # the final flush is done by close()
+                return
+
+            try:
+                await self.__flush__()
+            except TelegramRetryAfter as e:
+                logging.warning(f'Reply edits are rate limited, retrying after {e.retry_after}s')
+                await asyncio.sleep(e.retry_after)
+                self.__wakeup.set()
+                continue
+            except TelegramBadRequest as e:
+                if e.message.find('not found') != -1:
+                    # The message was deleted
+                    self.__error = e
+                    return
+                # intermediate texts might be incomplete markdown, the next flush will fix it
+                logging.debug(f'Failed to render intermediate reply: {e}')
+
+            await asyncio.sleep(self.__interval)
+
+    def update(self, text: str):
+        """
+        Sets the latest text of the response, raises if the replies can't be updated anymore.
+        """
+        if self.__error:
+            raise self.__error
+
+        self.__text = text
+        self.__wakeup.set()
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run__())
+
+    def cancel(self):
+        """
+        Stops the scheduler without flushing the pending text.
+        """
+        self.__closed = True
+        if self.__task:
+            self.__task.cancel()
+
+    async def close(self):
+        """
+        Flushes the final text of the response and stops the scheduler.
+        """
+        self.__closed = True
+        self.__wakeup.set()
+        if self.__task:
+            await self.__task
+        if self.__error:
+            raise self.__error
+
+        for attempt in range(FINAL_FLUSH_RETRIES):
+            try:
+                return await self.__flush__()
+            except TelegramRetryAfter as e:
+                if attempt == FINAL_FLUSH_RETRIES - 1:
+                    raise e
+                await asyncio.sleep(e.retry_after)
@@ -18,8 +18,11 @@ async def command_start_handler(message: Message, repo: ChatRepo) -> None:
     """
     chat: Chat = await repo.get_chat_session(message.chat.id)
 
-    if chat:
-        # Reset the chat session if it exists
-        await chat.reset()
+    try:
+        if chat:
+            # Reset the chat session if it exists
+            await chat.reset()
+    finally:
+        repo.release_chat_session(chat)
 
     await message.answer(f"Hello, {bold(message.from_user.full_name)}\!")
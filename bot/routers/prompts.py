@@ -1,3 +1,4 @@
+from contextlib import aclosing, suppress
 from logging import Logger, getLogger
 from aiogram import Router
 from aiogram.types import Message, InputMediaAudio, InputMediaPhoto
@@ -7,8 +8,9 @@ from google.genai.types import PartUnionDict
 from md2tgmd import escape
 
 from bot.middlewares.prompt_gen import PromptGenMiddleware
+from bot.renderer import ReplyRenderer
 from chat.repository import Chat, ChatRepo
-from utils.markdown import split_md
+from common.types.exceptions import TurnSupersededException
 
 logging: Logger = getLogger(__name__)
 
@@ -17,28 +19,6 @@ prompts_router = Router(name='message_router')
 
 prompts_router.message.middleware.register(PromptGenMiddleware())
 
-async def text_reply(reply_to: Message, text: str, replies: list[Message]) -> list[Message]:
-    if text.strip() != '':
-        # Split the response into chunks
-        chunks = split_md(text)
-
-        for i, chunk in enumerate(chunks):
-            # escape() converts Markdown to Telegram specific Markdown v2 format
-            chunk = escape(chunk)
-
-            text_reply = replies[i] if i < len(replies) else None
-
-            if text_reply and text_reply.md_text.strip() != chunk.strip():
-                # Update the reply chunks if there are changes
-                await text_reply.edit_text(text=chunk)
-            else:
-                prev_msg = replies[i - 1] if i > 0 else reply_to
-                # Send the chunk as a new reply
-                text_reply = await prev_msg.reply(text=chunk)
-                replies.append(text_reply)
-
-    return replies
-
 @prompts_router.message()
 async def echo_handler(message: Message, repo: ChatRepo, prompts: list[PartUnionDict] = [], sent: Message | None = None) -> None:
     """
@@ -46,54 +26,80 @@ async def echo_handler(message: Message, repo: ChatRepo, prompts: list[PartUnion
 
     By default, message handler will handle all message types (like a text, photo, sticker etc.)
     """
+    renderer: ReplyRenderer | None = None
+    chat: Chat | None = None
+    turn_prompts: list[PartUnionDict] | None = None
     try:
+        chat = await repo.get_chat_session(message.chat.id)
+        # a newer message may abort the answer in progress, it is answered along with this one
+        chat.supersede()
+        turn_prompts = await chat.coalesce(prompts)
+        if turn_prompts is None:
+            # The message is answered along with an earlier message of the chat
+            if sent:
+                await sent.delete()
+            return
+
         # Send a reply to the received message
         if sent:
             await sent.edit_text(text=italic("Thinking..."))
         else:
             sent = await message.reply(text=italic('Thinking...'))
 
-        chat: Chat = await repo.get_chat_session(message.chat.id)
-        text_replies = []
-        
         response = ""
         error: TelegramBadRequest | None = None
-        async for reply in chat.send_message_async(prompts):
-            try:
-                if isinstance(reply, list):
-                    if sent:
-                        await sent.delete()
-                        sent = None
-                    await message.reply_media_group(media=list(reply))
-                if isinstance(reply, InputMediaPhoto):
-                    if sent:
-                        await sent.delete()
-                        sent = None
-                    await message.reply_photo(photo=reply.media)
-                elif isinstance(reply, InputMediaAudio):
-                    if sent:
-                        await sent.delete()
-                        sent = None
-                    await message.reply_voice(voice=reply.media)
-                elif isinstance(reply, str):
-                    response = response + reply
-                    
-                    if reply.strip() != '':
-                        error = None
+        # close the replies right away on a break, so that the rest of the turn is cancelled
+        async with aclosing(chat.send_message_async(turn_prompts)) as replies:
+            async for reply in replies:
+                try:
+                    if isinstance(reply, list):
                         if sent:
-                            text_replies.append(sent)
+                            await sent.delete()
                             sent = None
+                        await message.reply_media_group(media=list(reply))
+                    if isinstance(reply, InputMediaPhoto):
+                        if sent:
+                            await sent.delete()
+                            sent = None
+                        await message.reply_photo(photo=reply.media)
+                    elif isinstance(reply, InputMediaAudio):
+                        if sent:
+                            await sent.delete()
+                            sent = None
+                        await message.reply_voice(voice=reply.media)
+                    elif isinstance(reply, str):
+                        response = response + reply
+                    
+                        if reply.strip() != '':
+                            error = None
+                            if renderer is None:
+                                renderer = ReplyRenderer(message, placeholder=sent)
+                                sent = None
                         
-                        text_replies = await text_reply(message, response, text_replies)
-            except TelegramBadRequest as e:
-                error = e
-                # Ignore intermediate errors
-                if e.message.find('not found') != -1:
-                    # The message was deleted
-                    break
+                            # the renderer collapses the updates and edits the replies at the chat's rate limit
+                            renderer.update(response)
+                except TelegramBadRequest as e:
+                    error = e
+                    # Ignore intermediate errors
+                    if e.message.find('not found') != -1:
+                        # The message was deleted
+                        break
 
         if error:
             raise error
+        if renderer:
+            await renderer.close()
+    except TurnSupersededException:
+        # The newer message is answered along with this one, drop the partial answer
+        logging.info(f'Answer of message {message.message_id} superseded by a newer message')
+        if renderer:
+            renderer.cancel()
+            for reply in renderer.replies:
+                with suppress(TelegramBadRequest):
+                    await reply.delete()
+        if sent:
+            with suppress(TelegramBadRequest):
+                await sent.delete()
     except TelegramBadRequest as e:
         # Ignore intermediate errors
         logging.warning(f'Failed to reply message: {message.text}, TelegramBadRequest: {e}')
@@ -108,4 +114,12 @@ async def echo_handler(message: Message, repo: ChatRepo, prompts: list[PartUnion
             await sent.edit_text(text=escape('Oops! Failed...\n\n') + pre(f'{(type(e).__name__)}: {e}'))
         else:
             await message.reply(text=escape('Oops! Failed...\n\n') + pre(f'{(type(e).__name__)}: {e}'))
+    finally:
+        if renderer:
+            renderer.cancel()
+        if chat and turn_prompts is not None:
+            # the turn may have failed before it was sealed, e.g. the placeholder was deleted
+            chat.release(turn_prompts)
+        if chat:
+            repo.release_chat_session(chat)
 
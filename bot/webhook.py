@@ -0,0 +1,123 @@
+import asyncio
+import time
+from logging import Logger, getLogger
+from os import getenv
+from typing import Any
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp.web import Request, Response, json_response
+
+from bot.middlewares.admission import MSG_HANDLING_CONCURRENCY, MSG_PRIORITY_SLOTS, MSG_QUEUE_SIZE
+
+logging: Logger = getLogger(__name__)
+
+WEBHOOK_QUEUE_SIZE = int(getenv('WEBHOOK_QUEUE_SIZE', '100'))
+WEBHOOK_DRAIN_TIMEOUT = float(getenv('WEBHOOK_DRAIN_TIMEOUT', '25'))
+WEBHOOK_SPARE_WORKERS = int(getenv('WEBHOOK_SPARE_WORKERS', '10'))
+# a worker stays blocked while its message waits for admission, there is one for every message the admission
+# can hold at a time, and a few spare ones, so the other updates don't queue behind the parked messages
+WEBHOOK_WORKERS = int(getenv('WEBHOOK_WORKERS', MSG_HANDLING_CONCURRENCY + MSG_PRIORITY_SLOTS + MSG_QUEUE_SIZE + WEBHOOK_SPARE_WORKERS))
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Acknowledges the webhook requests right away and handles the updates with a pool of workers.
+
+    The updates wait in a bounded queue, when it is full the request is rejected
+    so that Telegram delivers the update again later. The queued updates were acked already,
+    so on close the queue is drained, for at most `drain_timeout` seconds, before the workers are stopped.
+    """
+    __queue: asyncio.Queue[tuple[float, Bot, dict[str, Any]]]
+    __workers: list[asyncio.Task]
+    __worker_count: int
+    __busy: int
+    __processed: int
+    __failed: int
+    __shed: int
+    __max_depth: int
+    __total_wait: float
+    __max_wait: float
+    __drain_timeout: float
+    __closing: bool
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.__queue = asyncio.Queue(maxsize=queue_size)
+        self.__workers = []
+        self.__worker_count = workers
+        self.__busy = 0
+        self.__processed = 0
+        self.__failed = 0
+        self.__shed = 0
+        self.__max_depth = 0
+        self.__total_wait = 0
+        self.__max_wait = 0
+        self.__drain_timeout = drain_timeout
+        self.__closing = False
+
+    def __start_workers__(self):
+        # workers are started lazily, as there is no running loop while the handler is created
+        if len(self.__workers) == 0:
+            logging.info('Starting %d webhook workers with a queue of %d updates', self.__worker_count, self.__queue.maxsize)
+            self.__workers = [asyncio.create_task(self.__worker__()) for _ in range(self.__worker_count)]
+
+    async def __worker__(self):
+        while True:
+            enqueued_at, bot, update = await self.__queue.get()
+            wait = time.monotonic() - enqueued_at
+            self.__total_wait += wait
+            self.__max_wait = max(self.__max_wait, wait)
+            self.__busy += 1
+            try:
+                await self._background_feed_update(bot=bot, update=update)
+                self.__processed += 1
+            except Exception as e:
+                self.__failed += 1
+                logging.error(f'Failed to handle update {update.get("update_id")}: {e}', exc_info=True)
+            finally:
+                self.__busy -= 1
+                self.__queue.task_done()
+
+    async def _handle_request_background(self, bot: Bot, request: Request) -> Response:
+        if self.__closing:
+            # not acked, Telegram delivers the update again once the bot is back
+            return Response(status=503, text='Shutting down')
+
+        update = await request.json(loads=bot.session.json_loads)
+        try:
+            self.__queue.put_nowait((time.monotonic(), bot, update))
+        except asyncio.QueueFull:
+            self.__shed += 1
+            logging.warning(f'Webhook queue is full, rejecting update {update.get("update_id")}')
+            return Response(status=429, text='Too many pending updates')
+
+        self.__max_depth = max(self.__max_depth, self.__queue.qsize())
+        self.__start_workers__()
+        return json_response({}, dumps=bot.session.json_dumps)
+
+    def stats(self):
+        started = self.__processed + self.__failed + self.__busy
+        return {
+            'queued': self.__queue.qsize(),
+            'capacity': self.__queue.maxsize,
+            'max_depth': self.__max_depth,
+            'workers': len(self.__workers),
+            'busy_workers': self.__busy,
+            'processed': self.__processed,
+            'failed': self.__failed,
+            'shed': self.__shed,
+            'avg_wait': self.__total_wait / started if started else 0,
+            'max_wait': self.__max_wait,
+        }
+
+    async def close(self) -> None:
+        self.__closing = True
+        if self.__workers:
+            try:
+                async with asyncio.timeout(self.__drain_timeout):
+                    await self.__queue.join()
+            except TimeoutError:
+                logging.warning(f'Webhook queue not drained in {self.__drain_timeout}s, dropping {self.__queue.qsize()} updates and {self.__busy} in progress')
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+        await super().close()
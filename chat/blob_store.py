@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from logging import Logger, getLogger
+from os import makedirs, path, replace
+from google.genai.types import Blob, Content, FileData, Part
+
+logging: Logger = getLogger(__name__)
+
+BLOB_URI_SCHEME = 'blobstore'
+
+def parse_blob_uri(uri: str) -> tuple[str, int] | None:
+    """Returns the hash and size of the blob of the uri, if it refers to the `BlobStore`."""
+    scheme, _, ref = uri.partition(':')
+    if scheme != BLOB_URI_SCHEME:
+        return None
+    digest, _, size = ref.partition('/')
+    return (digest, int(size or 0))
+
+def blob_ref(part: Part) -> tuple[str, int] | None:
+    """Returns the hash and size of the blob referenced by the part, if it refers to the `BlobStore`."""
+    if part.file_data is None or part.file_data.file_uri is None:
+        return None
+    return parse_blob_uri(part.file_data.file_uri)
+
+class BlobStore():
+    """Content addressed store for the media of the chat histories.
+
+    The histories keep only references to the media, which are resolved right before a request.
+    Every blob is written once to `path`, no matter how many chats share it, and read back when a
+    request needs it. The recently used blobs are cached in memory up to `memory_budget` bytes.
+
+    Nothing refers to a blob once its turn is summarized or the chat is reset, `sweep()` deletes the
+    blobs which are not referenced anymore. The blobs written or resolved within `grace_period`
+    seconds are always kept, their references might not be in any history yet.
+    """
+    __path: str
+    __memory_budget: int
+    __min_size: int
+    __grace_period: float
+    __cache: OrderedDict[str, bytes]
+    __cached_bytes: int
+    __used: dict[str, float]
+    __lock: threading.Lock
+
+    def __init__(self, path: str = 'data/blobs', memory_budget: int = 32 * 1024 * 1024, min_size: int = 1024, grace_period: float = 3600) -> None:
+        self.__path = path
+        self.__memory_budget = memory_budget
+        self.__min_size = min_size
+        self.__grace_period = grace_period
+        self.__cache = OrderedDict()
+        self.__cached_bytes = 0
+        # when the blobs were last resolved, a history being sent holds the media instead of the references
+        self.__used = {}
+        self.__lock = threading.Lock()
+
+    def __blob_path__(self, digest: str):
+        return path.join(self.__path, digest[:2], digest)
+
+    def __cache_put__(self, digest: str, data: bytes):
+        if digest in self.__cache:
+            self.__cache.move_to_end(digest)
+            return
+        self.__cache[digest] = data
+        self.__cached_bytes += len(data)
+        while self.__cached_bytes > self.__memory_budget and len(self.__cache) > 1:
+            _, evicted = self.__cache.popitem(last=False)
+            self.__cached_bytes -= len(evicted)
+
+    def __write__(self, blobs: list[bytes]) -> list[str]:
+        digests: list[str] = []
+        for data in blobs:
+            digest = hashlib.sha256(data).hexdigest()
+            file = self.__blob_path__(digest)
+            with self.__lock:
+                if path.exists(file):
+                    # a blob referred to again is new to the sweep, it might not be in any history yet
+                    os.utime(file)
+                else:
+                    makedirs(path.dirname(file), exist_ok=True)
+                    # write to a temp file first, a reader must never see a partial blob
+                    with open(f'{file}.tmp', 'wb') as f:
+                        f.write(data)
+                    replace(f'{file}.tmp', file)
+            digests.append(digest)
+        return digests
+
+    def __read__(self, digest: str) -> bytes | None:
+        try:
+            with open(self.__blob_path__(digest), 'rb') as f:
+                return f.read()
+        except OSError as e:
+            logging.warning(f'Failed to read blob {digest}: {e}')
+            return None
+
+    async def externalize(self, history: list[Content]):
+        """Moves the inline media of the history to the store, and puts references in their place."""
+        found: list[tuple[Content, int, Part]] = []
+        for content in history:
+            for i, part in enumerate(content.parts or []):
+                if part.inline_data and part.inline_data.data and len(part.inline_data.data) >= self.__min_size:
+                    found.append((content, i, part))
+        if len(found) == 0:
+            return
+
+        blobs = [part.inline_data.data for _, _, part in found if part.inline_data and part.inline_data.data]
+        digests = await asyncio.to_thread(self.__write__, blobs)
+        for (content, i, part), digest, data in zip(found, digests, blobs):
+            self.__cache_put__(digest, data)
+            if content.parts and i < len(content.parts) and content.parts[i] is part:
+                mime_type = part.inline_data.mime_type if part.inline_data else None
+                content.parts[i] = Part(file_data=FileData(file_uri=f'{BLOB_URI_SCHEME}:{digest}/{len(data)}', mime_type=mime_type))
+        logging.debug(f'Externalized {len(found)} blobs of {sum(len(data) for data in blobs)} bytes')
+
+    async def resolve(self, history: list[Content]) -> list[Content]:
+        """Returns a copy of the history with the references replaced by the inline media."""
+        blobs: dict[str, bytes] = {}
+        missing: set[str] = set()
+        now = time.time()
+        for content in history:
+            for part in content.parts or []:
+                if (ref := blob_ref(part)) is None:
+                    continue
+                self.__used[ref[0]] = now
+                if (data := self.__cache.get(ref[0])) is not None:
+                    self.__cache.move_to_end(ref[0])
+                    blobs[ref[0]] = data
+                else:
+                    missing.add(ref[0])
+        if missing:
+            reads = await asyncio.gather(*(asyncio.to_thread(self.__read__, digest) for digest in missing))
+            for digest, data in zip(missing, reads):
+                if data is not None:
+                    blobs[digest] = data
+                    self.__cache_put__(digest, data)
+
+        resolved: list[Content] = []
+        for content in history:
+            if not any(blob_ref(part) for part in content.parts or []):
+                resolved.append(content)
+                continue
+            parts: list[Part] = []
+            for part in content.parts or []:
+                ref = blob_ref(part)
+                mime_type = part.file_data.mime_type if part.file_data else None
+                if ref is None:
+                    parts.append(part)
+                elif (data := blobs.get(ref[0])) is not None:
+                    parts.append(Part(inline_data=Blob(mime_type=mime_type, data=data)))
+                else:
+                    # better an answer without the media than no answer at all
+                    parts.append(Part(text=f'<{mime_type} missing>'))
+            resolved.append(content.model_copy(update={'parts': parts}))
+        return resolved
+
+    def __sweep__(self, keep: set[str]) -> tuple[int, int]:
+        deleted, freed = 0, 0
+        expired = time.time() - self.__grace_period
+        if not path.isdir(self.__path):
+            return (deleted, freed)
+        for dir in os.scandir(self.__path):
+            if not dir.is_dir():
+                continue
+            for entry in os.scandir(dir.path):
+                digest = entry.name.removesuffix('.tmp')
+                with self.__lock:
+                    try:
+                        stat = entry.stat()
+                        if digest in keep or stat.st_mtime > expired:
+                            continue
+                        os.remove(entry.path)
+                    except OSError as e:
+                        logging.warning(f'Failed to delete blob {entry.name}: {e}')
+                        continue
+                deleted += 1
+                freed += stat.st_size
+        return (deleted, freed)
+
+    async def sweep(self, live: set[str]):
+        """Deletes the blobs which are not in `live`, the digests of the blobs referred to by any history."""
+        expired = time.time() - self.__grace_period
+        self.__used = {digest: used for digest, used in self.__used.items() if used > expired}
+        deleted, freed = await asyncio.to_thread(self.__sweep__, live | self.__used.keys())
+        for digest in [digest for digest in self.__cache if digest not in live and digest not in self.__used]:
+            self.__cached_bytes -= len(self.__cache.pop(digest))
+        logging.info(f'Deleted {deleted} unreferenced blobs of {freed} bytes')
+
+    def stats(self):
+        return {
+            'cached': len(self.__cache),
+            'cached_bytes': self.__cached_bytes,
+        }
@@ -0,0 +1,141 @@
+from logging import Logger, getLogger
+from google.genai.types import Content, Part
+
+from chat.blob_store import blob_ref
+from common.constants.keywords import CONVERSATION_SUMMARY, VOICE_TRANSCRIPT
+
+logging: Logger = getLogger(__name__)
+
+class HistoryManager():
+    """Keeps a chat history within a token budget, so the prompt size stays flat for long conversations.
+
+    The latest `keep_turns` turns are always kept verbatim. Inline media is removed from the turns older
+    than `keep_media_turns`, and the oldest turns are folded into a running summary (bounded by
+    `summary_budget` tokens) until the history fits in `token_budget`.
+    """
+    token_budget: int
+    keep_turns: int
+    keep_media_turns: int
+    summary_budget: int
+    chars_per_token = 4
+    image_tokens = 258
+    excerpt_size = 200
+
+    def __init__(self, token_budget: int = 16000, keep_turns: int = 4, keep_media_turns: int = 2, summary_budget: int = 1000) -> None:
+        self.token_budget = token_budget
+        self.keep_turns = max(keep_turns, 1)
+        self.keep_media_turns = max(keep_media_turns, 1)
+        self.summary_budget = summary_budget
+
+    def __media_tokens__(self, mime_type: str | None, size: int) -> int:
+        if mime_type and mime_type.startswith('image'):
+            return self.image_tokens
+        # audio/video is billed by duration, roughly 1 token per 100 bytes of compressed media
+        return size // 100 + 1
+
+    def __part_tokens__(self, part: Part) -> int:
+        if part.text:
+            return len(part.text) // self.chars_per_token + 1
+        elif part.inline_data and part.inline_data.data:
+            return self.__media_tokens__(part.inline_data.mime_type, len(part.inline_data.data))
+        elif (ref := blob_ref(part)) is not None and part.file_data:
+            return self.__media_tokens__(part.file_data.mime_type, ref[1])
+        elif part.function_call:
+            return len(str(part.function_call.args)) // self.chars_per_token + 1
+        elif part.function_response:
+            return len(str(part.function_response.response)) // self.chars_per_token + 1
+        return 1
+
+    def count_tokens(self, history: list[Content]) -> int:
+        return sum(self.__part_tokens__(part) for content in history for part in content.parts or [])
+
+    def __is_turn_start__(self, content: Content) -> bool:
+        # function responses are sent by the user role as well, but are a continuation of the model turn,
+        # even when the prompts are resent along with them, a call must never be kept without its response
+        return content.role == 'user' and not any(part.function_response for part in content.parts or [])
+
+    def __split_turns__(self, history: list[Content]) -> list[list[Content]]:
+        turns: list[list[Content]] = []
+        for content in history:
+            if len(turns) == 0 or self.__is_turn_start__(content):
+                turns.append([])
+            turns[-1].append(content)
+        return turns
+
+    def __pop_summary__(self, turns: list[list[Content]]) -> list[str]:
+        if len(turns) == 0 or not turns[0][0].parts:
+            return []
+        first = turns[0][0]
+        if first.parts and first.parts[0].text and first.parts[0].text.startswith(f"{CONVERSATION_SUMMARY}:"):
+            summary = first.parts.pop(0).text or ''
+            return summary.splitlines()[1:]
+        return []
+
+    def __excerpt__(self, text: str) -> str:
+        text = ' '.join(text.split())
+        return text if len(text) <= self.excerpt_size else text[:self.excerpt_size] + '...'
+
+    def __summarize_turn__(self, turn: list[Content]) -> list[str]:
+        lines: list[str] = []
+        for content in turn:
+            texts: list[str] = []
+            for part in content.parts or []:
+                if part.text and not part.text.startswith(f"{CONVERSATION_SUMMARY}:"):
+                    texts.append(part.text)
+                elif part.function_call:
+                    texts.append(f"<called {part.function_call.name}>")
+                elif part.inline_data:
+                    texts.append(f"<{part.inline_data.mime_type}>")
+                elif part.file_data:
+                    texts.append(f"<{part.file_data.mime_type}>")
+            if texts:
+                lines.append(f"  {content.role}: {self.__excerpt__(' '.join(texts))}")
+        return lines
+
+    def __strip_media__(self, turn: list[Content]):
+        for content in turn:
+            for i, part in enumerate(content.parts or []):
+                if part.inline_data:
+                    content.parts[i] = Part(text=f"<{part.inline_data.mime_type} omitted>")
+                elif part.file_data and blob_ref(part):
+                    content.parts[i] = Part(text=f"<{part.file_data.mime_type} omitted>")
+
+    def drop_transcribed_audio(self, history: list[Content]):
+        """Drops the audio sent along with its transcript, it is needed only for the turn it was sent in."""
+        for content in history:
+            if content.role != 'user' or not content.parts:
+                continue
+            if any(part.text and part.text.startswith(f"{VOICE_TRANSCRIPT}:") for part in content.parts):
+                content.parts = [
+                    part for part in content.parts
+                    if not (part.inline_data and part.inline_data.mime_type and part.inline_data.mime_type.startswith('audio'))
+                ]
+
+    def compact(self, history: list[Content]):
+        """Compacts the history in place, must not be called while a response is being generated."""
+        turns = self.__split_turns__(history)
+        summary = self.__pop_summary__(turns)
+
+        for turn in turns[:-self.keep_media_turns]:
+            self.__strip_media__(turn)
+
+        tokens = sum(self.count_tokens(turn) for turn in turns)
+        dropped = 0
+        while tokens > self.token_budget and len(turns) > self.keep_turns:
+            turn = turns.pop(0)
+            tokens -= self.count_tokens(turn)
+            summary.extend(self.__summarize_turn__(turn))
+            dropped += 1
+
+        # keep the summary bounded, the oldest lines go first
+        while summary and sum(len(line) for line in summary) // self.chars_per_token > self.summary_budget:
+            summary.pop(0)
+
+        if dropped:
+            logging.debug(f"Dropped {dropped} turns from history, {tokens} tokens left")
+
+        history.clear()
+        for turn in turns:
+            history.extend(turn)
+        if summary and history and history[0].parts is not None:
+            history[0].parts.insert(0, Part(text=f"{CONVERSATION_SUMMARY}:\n" + '\n'.join(summary)))
@@ -1,10 +1,12 @@
+import asyncio
 from logging import Logger, getLogger
 from typing import AsyncGenerator, Union
-from aiogram.types import InputMediaPhoto, InputMediaAudio, URLInputFile, BufferedInputFile
+from aiogram.types import InputMediaPhoto, InputMediaAudio, BufferedInputFile
 from google.genai import chats, types
 from pydantic import BaseModel
 import time
 
+from chat.search_compactor import SearchCompactor
 from chat.services.gemini import GeminiService
 from chat.services.tavily import TavilyService
 from chat.services.voice import VoiceService
@@ -12,9 +14,12 @@ from chat.services.img_gen import ImgGenService
 from chat.tools.generation import GenerateImageFunctionCall, GenerateImageParams, GenerateVoiceFunctionCall, GenerateVoiceParams
 from chat.tools.search import DuckduckgoSearchFunctionCall, TavilySearchFunctionCall, TavilySearchParams, TavilySearchResults
 from common.constants.keywords import IMAGE_QUERY, SEARCH_QUERIES, VOICE_RESPONSE
+from common.types.exceptions import ServiceOverloadedException
+from utils.image import downscale_image
 
 logging: Logger = getLogger(__name__)
 
+FunctionCallType = Union[GenerateImageFunctionCall, GenerateVoiceFunctionCall, TavilySearchFunctionCall]
 ModelEventType = Union[str, GenerateImageFunctionCall, GenerateVoiceFunctionCall, DuckduckgoSearchFunctionCall, TavilySearchFunctionCall]
 OutputEventType = Union[str, InputMediaPhoto, InputMediaAudio, list[InputMediaPhoto]]
 
@@ -23,38 +28,46 @@ class QueryProcessor():
     __voice: VoiceService
     __img_gen: ImgGenService
     __tavily: TavilyService
+    __compactor: SearchCompactor
+    __history_image_size: int
     __query_list__ = [
         IMAGE_QUERY,
         SEARCH_QUERIES,
         VOICE_RESPONSE
     ]
 
-    def __init__(self, gemini: GeminiService, voice: VoiceService, img_gen: ImgGenService, tavily: TavilyService) -> None:
+    def __init__(self, gemini: GeminiService, voice: VoiceService, img_gen: ImgGenService, tavily: TavilyService, compactor: SearchCompactor, history_image_size: int = 384) -> None:
         self.__gemini = gemini
         self.__voice = voice
         self.__img_gen = img_gen
         self.__tavily = tavily
+        self.__compactor = compactor
+        self.__history_image_size = history_image_size
 
     async def __tavily_search_function_call__(self, args: TavilySearchParams):
         logging.debug(f"Generating live data prompt for query: {args.query}")
 
         result = await self.__tavily.search(args.query.strip(), max_results=args.max_results, topic=args.topic)
 
-        return TavilySearchResults.model_validate(result)
+        # the response stays in the chat history, only the relevant parts of the results are kept
+        return self.__compactor.compact(TavilySearchResults.model_validate(result))
     
     async def __gen_image_function_call__(self, args: GenerateImageParams):
         logging.debug(f"Generate image query: {args.prompt}")
-        image_responses = await self.__img_gen.gen_image_response(args.prompt)
+        image_responses = await self.__img_gen.gen_image_response(args.prompt, quality=args.quality)
         
-        responses = [InputMediaPhoto(media=URLInputFile(res.url, filename=f'{args.image_name}.jpeg')) for res in image_responses]
-        blobs = [res.blob for res in image_responses]
+        # upload the downloaded bytes, rather than letting Telegram fetch the url once more
+        responses = [InputMediaPhoto(media=BufferedInputFile(res.blob.data or b'', filename=f'{args.image_name}.jpeg')) for res in image_responses]
+        # the user gets the full image, the history keeps a small copy which is resent on every turn
+        blobs = await asyncio.gather(*(asyncio.to_thread(downscale_image, res.blob, self.__history_image_size) for res in image_responses))
         
         return (responses, blobs)
     
     async def __gen_voice_function_call__(self, args: GenerateVoiceParams, chat_id: int):
         logging.debug(f"Generate voice query: {args.text}")
-        file_name = f"voice_{chat_id}_{int(time.time())}.wav"
-        voice_response = await self.__voice.text_to_wave(args.text)
+        voice_response = await self.__voice.text_to_voice(args.text, key=chat_id)
+        extension = 'ogg' if voice_response.blob.mime_type == 'audio/ogg' else 'wav'
+        file_name = f"voice_{chat_id}_{int(time.time())}.{extension}"
 
         return (InputMediaAudio(media=BufferedInputFile(voice_response.data, filename=file_name)), voice_response.blob)
 
@@ -67,49 +80,91 @@ class QueryProcessor():
     
     async def handle_event(
         self,
-        event: ModelEventType,
+        event: FunctionCallType,
         session: chats.AsyncChat,
-        messages: list[types.PartUnionDict],
         chat_id: int
-    ) -> AsyncGenerator[OutputEventType, None]:
-        if isinstance(event, str):
-            yield event
-        elif isinstance(event, GenerateImageFunctionCall):
+    ) -> tuple[OutputEventType | None, types.FunctionResponse | None]:
+        """
+        Runs a function call, returns the output for the user and the response to be sent back to the model.
+        """
+        if isinstance(event, GenerateImageFunctionCall):
             image_responses, image_blobs = await self.__gen_image_function_call__(event.args)
             parts = [
                 types.Part(inline_data=blob) for blob in image_blobs
             ]
             self.__gemini.function_call_replace(parts, event, session)
-            
-            yield image_responses
+
+            return (image_responses, None)
         elif isinstance(event, GenerateVoiceFunctionCall):
-            voice_response, voice_blob = await self.__gen_voice_function_call__(event.args, chat_id)
+            try:
+                voice_response, voice_blob = await self.__gen_voice_function_call__(event.args, chat_id)
+            except (ServiceOverloadedException, TimeoutError) as e:
+                # the voice is too far away, reply with the text instead
+                logging.warning(f"Replying with text instead of voice in chat {chat_id}: {type(e).__name__}")
+                self.__gemini.function_call_replace([types.Part(text=event.args.text)], event, session)
+                return (f"\n\n{event.args.text}", None)
             parts = [
                 types.Part(inline_data=voice_blob)
             ]
             self.__gemini.function_call_replace(parts, event, session)
-            
-            yield voice_response
+
+            return (voice_response, None)
         elif isinstance(event, TavilySearchFunctionCall):
             search_result = await self.__tavily_search_function_call__(event.args)
-            func_response = self.__build_func_response(event, search_result)
-            response_stream = self.process_response(session, messages, chat_id, function_response=func_response)
+            return (None, self.__build_func_response(event, search_result))
+        return (None, None)
 
-            async for res in response_stream:
-                yield res
+    async def __handle_function_calls__(
+        self,
+        function_calls: list[FunctionCallType],
+        session: chats.AsyncChat,
+        chat_id: int
+    ) -> AsyncGenerator[tuple[int, OutputEventType | None, types.FunctionResponse | None], None]:
+        # the calls of a model turn are independent, run them all at once and yield them as they complete
+        async def call(index: int, function_call: FunctionCallType):
+            return (index, *await self.handle_event(function_call, session, chat_id))
+
+        tasks = [asyncio.create_task(call(i, function_call)) for i, function_call in enumerate(function_calls)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # a failed or cancelled call aborts the rest of them
+            for task in tasks:
+                task.cancel()
+            # wait for them to unwind before the history is touched, and retrieve their exceptions
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def process_response(
         self,
         session: chats.AsyncChat,
         messages: list[types.PartUnionDict],
         chat_id: int,
-        function_response: types.FunctionResponse | None = None
+        function_responses: list[types.FunctionResponse] = []
     ) -> AsyncGenerator[OutputEventType, None]:
-        response_stream = self.__gemini.gen_response_stream(prompts=messages, chat=session, function_response=function_response)
+        response_stream = self.__gemini.gen_response_stream(prompts=messages, chat=session, function_responses=function_responses)
 
+        function_calls: list[FunctionCallType] = []
         async for event in response_stream:
             if event is None:
                 continue
-            
-            async for res in self.handle_event(event, session, messages, chat_id):
+            if isinstance(event, str):
+                yield event
+            else:
+                function_calls.append(event)
+
+        if len(function_calls) == 0:
+            return
+
+        results: dict[int, types.FunctionResponse] = {}
+        async for index, output, func_response in self.__handle_function_calls__(function_calls, session, chat_id):
+            if output is not None:
+                yield output
+            if func_response is not None:
+                results[index] = func_response
+
+        if results:
+            # all the responses go back to the model in a single turn, in the order of the calls
+            response_stream = self.process_response(session, messages, chat_id, function_responses=[results[i] for i in sorted(results)])
+            async for res in response_stream:
                 yield res
@@ -1,49 +1,321 @@
 import asyncio
-from typing import Iterable, Union
+import time
+from collections import OrderedDict
+from logging import Logger, getLogger
 from google.genai.chats import AsyncChat
 from google.genai.types import Content, PartUnionDict
 
+from chat.blob_store import BlobStore, blob_ref
+from chat.history import HistoryManager
 from chat.services.gemini import GeminiService
 from chat.query_processor import QueryProcessor
+from chat.store import ChatStore
+from common.types.enums import SupersedePolicy
+from common.types.exceptions import TurnSupersededException
+from utils.aiotimer import Deadline, scheduler
+from utils.keyed_lock import KeyedLock
+
+logging: Logger = getLogger(__name__)
 
 class Chat():
     __id: int
     __session: AsyncChat
     __processor: QueryProcessor
-    __chat_init_history: list[Content]
-    __sem = asyncio.BoundedSemaphore(1)
+    __history: HistoryManager
+    __blobs: BlobStore
+    __locks: KeyedLock[int]
+    __coalesce_window: float
+    __pending: list[PartUnionDict] | None
+    __supersede_policy: SupersedePolicy
+    __turn: asyncio.Task | None
+    __superseded: list[PartUnionDict]
+    last_active: float
+    dirty: bool
+    users: int
+    expiry: Deadline | None
 
-    def __init__(self, id: int, session: AsyncChat, processor: QueryProcessor):
+    def __init__(self, id: int, session: AsyncChat, processor: QueryProcessor, history: HistoryManager, blobs: BlobStore, locks: KeyedLock[int], coalesce_window: float = 0, supersede_policy: SupersedePolicy = SupersedePolicy.none):
         self.__id = id
         self.__session = session
         self.__processor = processor
-        self.__chat_init_history = session._curated_history
+        self.__history = history
+        self.__blobs = blobs
+        self.__locks = locks
+        self.__coalesce_window = coalesce_window
+        self.__pending = None
+        self.__supersede_policy = supersede_policy
+        self.__turn = None
+        self.__superseded = []
+        self.last_active = time.monotonic()
+        self.dirty = False
+        self.users = 0
+        self.expiry = None
+
+    @property
+    def id(self):
+        return self.__id
+
+    @property
+    def history(self) -> list[Content]:
+        return self.__session._curated_history
+
+    @property
+    def busy(self):
+        # a handler holds the chat from the lookup on, well before it takes the lock of the chat
+        return self.users > 0 or self.__locks.in_use(self.__id)
+
+    @property
+    def collecting(self):
+        """Whether a turn is collecting messages, i.e. a new message would be merged into it."""
+        return self.__pending is not None
+
+    async def coalesce(self, messages: list[PartUnionDict]) -> list[PartUnionDict] | None:
+        """Merges the messages into the next turn of the chat.
+
+        Returns the prompts of the next turn if the caller should send it, or None if the messages
+        were merged into a turn which is already waiting to be sent by another caller.
+        """
+        if self.__coalesce_window <= 0:
+            return messages
+        if self.__pending is not None:
+            self.__pending.extend(messages)
+            return None
+
+        self.__pending = pending = list(messages)
+        try:
+            await asyncio.sleep(self.__coalesce_window)
+        except asyncio.CancelledError:
+            if self.__pending is pending:
+                self.__pending = None
+            raise
+        # the turn keeps collecting messages until it gets hold of the chat lock
+        return pending
+
+    def release(self, messages: list[PartUnionDict]):
+        """Stops collecting messages into the turn returned by `coalesce()`.
+
+        `send_message_async()` does it once the turn is sealed, the owner of the turn must call it
+        on every other path, otherwise the later messages of the chat are merged into a dead turn.
+        """
+        if messages is self.__pending:
+            self.__pending = None
+
+    def supersede(self):
+        """Aborts the turn in progress for a newer message, if the policy of the chat allows it.
+
+        The prompts of the aborted turn are answered along with the next turn.
+        """
+        if self.__supersede_policy is SupersedePolicy.newer and self.__turn is not None and not self.__turn.done():
+            logging.info(f'Superseding the turn in progress of chat {self.__id}')
+            self.__turn.cancel()
+
+    async def __generate__(self, messages: list[PartUnionDict], replies: asyncio.Queue):
+        async for reply in self.__processor.process_response(session=self.__session, messages=messages, chat_id=self.__id):
+            replies.put_nowait(reply)
 
     async def send_message_async(self, messages: list[PartUnionDict]):
-        async with self.__sem:
-            # generate new response only if earlier responses are complete
-            async for reply in self.__processor.process_response(session=self.__session, messages=messages, chat_id=self.__id):
-                yield reply
-    
+        async with self.__locks(self.__id):
+            self.release(messages)
+            if self.__superseded:
+                messages = [*self.__superseded, *messages]
+                self.__superseded = []
+            history = self.__session._curated_history
+            try:
+                # keep the resent history within the token budget
+                self.__history.compact(history)
+                history_size = len(history)
+
+                # the turn runs in its own task, so that it can be cancelled without cancelling the caller
+                replies: asyncio.Queue = asyncio.Queue()
+                self.__turn = turn = asyncio.create_task(self.__generate__(messages, replies))
+                turn.add_done_callback(lambda _: replies.put_nowait(None))
+                try:
+                    while (reply := await replies.get()) is not None:
+                        yield reply
+                finally:
+                    self.__turn = None
+                    if not turn.done():
+                        # nobody listens to the replies anymore, stop paying for the rest of the turn
+                        turn.cancel()
+                        await asyncio.wait([turn])
+                    if turn.cancelled():
+                        # a partial turn can't be resent, e.g. a function call without its response
+                        del history[history_size:]
+
+                if turn.cancelled():
+                    self.__superseded = messages
+                    raise TurnSupersededException('The turn was superseded by a newer message')
+                turn.result()
+            finally:
+                self.__history.drop_transcribed_audio(history)
+                try:
+                    # keep only references to the media of the turn in memory
+                    await self.__blobs.externalize(history)
+                except Exception as e:
+                    logging.warning(f'Failed to externalize the media of chat {self.__id}: {e}')
+                self.dirty = True
+                self.last_active = time.monotonic()
+
     async def reset(self):
-        self.__session._curated_history.clear()
-        self.__session._curated_history.extend(self.__chat_init_history)
+        async with self.__locks(self.__id):
+            self.__session._curated_history.clear()
+            self.dirty = True
 
 class ChatRepo():
+    """Keeps the recently active chats in memory and spills the cold ones to the `ChatStore`.
+
+    A chat is evicted when it is the least recently used one above `max_sessions`,
+    or when it has been idle for more than `idle_timeout` seconds.
+    """
     __gemini: GeminiService
-    __chats: dict[int, Chat]
-    __chat_creation_sem = asyncio.BoundedSemaphore(1)
+    __chats: OrderedDict[int, Chat]
+    __evicting: dict[int, Chat]
     __query_processor: QueryProcessor
+    __history: HistoryManager
+    __blobs: BlobStore
+    __store: ChatStore
+    __locks: KeyedLock[int]
+    __creation_locks: KeyedLock[int]
+    __max_sessions: int
+    __idle_timeout: float
+    __coalesce_window: float
+    __supersede_policy: SupersedePolicy
+    __overflow: Deadline | None
+    __blob_sweep_interval: float
+    __blob_sweep: Deadline | None
 
-    def __init__(self, gemini: GeminiService, processor: QueryProcessor) -> None:
+    def __init__(self, gemini: GeminiService, processor: QueryProcessor, history: HistoryManager, blobs: BlobStore, store: ChatStore, max_sessions: int = 100, idle_timeout: float = 1800, coalesce_window: float = 0, supersede_policy: SupersedePolicy = SupersedePolicy.none, blob_sweep_interval: float = 6 * 3600) -> None:
         self.__gemini = gemini
-        self.__chats = {}
+        self.__chats = OrderedDict()
+        self.__evicting = {}
         self.__query_processor = processor
+        self.__history = history
+        self.__blobs = blobs
+        self.__store = store
+        self.__locks = KeyedLock()
+        self.__creation_locks = KeyedLock()
+        self.__max_sessions = max_sessions
+        self.__idle_timeout = idle_timeout
+        self.__coalesce_window = coalesce_window
+        self.__supersede_policy = supersede_policy
+        self.__overflow = None
+        self.__blob_sweep_interval = blob_sweep_interval
+        self.__blob_sweep = None
+
+    def __overflow_chats__(self):
+        cold: list[Chat] = []
+        overflow = len(self.__chats) - self.__max_sessions
+
+        # chats are kept in least recently used order
+        for chat in self.__chats.values():
+            if overflow <= 0:
+                break
+            if not chat.busy:
+                cold.append(chat)
+                overflow -= 1
+        return cold
+
+    async def __expire__(self, chat: Chat):
+        if self.__chats.get(chat.id) is not chat:
+            return
+        idle = time.monotonic() - chat.last_active
+        if chat.busy or idle < self.__idle_timeout:
+            # still in use, check again once it could be idle for long enough
+            chat.expiry = scheduler.schedule(max(self.__idle_timeout - idle, 1), self.__expire__, chat)
+            return
+        await self.__evict__([chat])
+
+    async def __evict_overflow__(self):
+        self.__overflow = None
+        await self.__evict__(self.__overflow_chats__())
+
+    async def __evict__(self, cold: list[Chat]):
+        if len(cold) == 0:
+            return
+
+        for chat in cold:
+            self.__chats.pop(chat.id, None)
+            scheduler.cancel(chat.expiry)
+            # keep the evicted chats reachable until they are saved, a lookup must not load a stale copy
+            self.__evicting[chat.id] = chat
+        logging.debug(f"Evicting {len(cold)} chats, {len(self.__chats)} chats left in memory")
+        try:
+            dirty = [chat for chat in cold if chat.dirty]
+            if not await self.__store.save({chat.id: chat.history for chat in dirty}):
+                # keep the unsaved chats in memory rather than dropping their history
+                for chat in dirty:
+                    if chat.id not in self.__chats:
+                        self.__chats[chat.id] = chat
+                        self.__chats.move_to_end(chat.id, last=False)
+                        chat.expiry = scheduler.schedule(self.__idle_timeout, self.__expire__, chat)
+        finally:
+            for chat in cold:
+                if self.__evicting.get(chat.id) is chat:
+                    del self.__evicting[chat.id]
+
+    async def __sweep_blobs__(self):
+        self.__blob_sweep = scheduler.schedule(self.__blob_sweep_interval, self.__sweep_blobs__)
+        # the chats in memory first, a chat evicted meanwhile is in the store by the time it is read
+        live = {
+            ref[0]
+            for chat in [*self.__chats.values(), *self.__evicting.values()]
+            for content in chat.history
+            for part in content.parts or []
+            if (ref := blob_ref(part)) is not None
+        }
+        stored = await self.__store.blob_refs()
+        if stored is None:
+            # without the references of the stored chats every blob would look unreferenced
+            return
+        await self.__blobs.sweep(live | stored)
+
+    async def __create_chat__(self, chat_id: int):
+        # single flight, concurrent first messages of a chat must share the same session
+        async with self.__creation_locks(chat_id):
+            if (chat := self.__chats.get(chat_id)) is not None:
+                return chat
+
+            chat = self.__evicting.get(chat_id)
+            if chat is None:
+                history = await self.__store.load(chat_id)
+                session = self.__gemini.create_chat_session(history=history or [])
+                chat = Chat(id=chat_id, session=session, processor=self.__query_processor, history=self.__history, blobs=self.__blobs, locks=self.__locks, coalesce_window=self.__coalesce_window, supersede_policy=self.__supersede_policy)
+            self.__chats[chat_id] = chat
+            return chat
 
     async def get_chat_session(self, chat_id: int):
-        async with self.__chat_creation_sem:
-            if chat_id not in self.__chats.keys():
-                session = self.__gemini.create_chat_session()
-                self.__chats[chat_id] = Chat(id=chat_id, session=session, processor=self.__query_processor)
-        return self.__chats[chat_id]
-    
\ No newline at end of file
+        """Returns the chat, which is kept in memory until it is handed back with `release_chat_session()`."""
+        chat = self.__chats.get(chat_id)
+        if chat is None:
+            chat = await self.__create_chat__(chat_id)
+
+        chat.users += 1
+        chat.last_active = time.monotonic()
+        chat.expiry = scheduler.reschedule(chat.expiry, self.__idle_timeout, self.__expire__, chat)
+        self.__chats.move_to_end(chat_id)
+        if len(self.__chats) > self.__max_sessions and self.__overflow is None:
+            # the evicted chats are written to disk, which must not hold up the lookup
+            self.__overflow = scheduler.schedule(0, self.__evict_overflow__)
+        if self.__blob_sweep is None and self.__blob_sweep_interval > 0:
+            # the first sweep cleans up after the previous run
+            self.__blob_sweep = scheduler.schedule(0, self.__sweep_blobs__)
+        return chat
+
+    def release_chat_session(self, chat: Chat):
+        chat.users -= 1
+        chat.last_active = time.monotonic()
+
+    def collecting(self, chat_id: int) -> bool:
+        """Whether the chat is in memory and a new message of it would be merged into a pending turn."""
+        chat = self.__chats.get(chat_id)
+        return chat is not None and chat.collecting
+
+    async def flush(self):
+        """Persists all the modified chats, so that they survive a restart."""
+        dirty = [chat for chat in self.__chats.values() if chat.dirty]
+        # cleared before yielding, a turn finishing during the save marks its chat dirty again
+        for chat in dirty:
+            chat.dirty = False
+        if not await self.__store.save({chat.id: chat.history for chat in dirty}):
+            for chat in dirty:
+                chat.dirty = True
@@ -0,0 +1,93 @@
+import re
+from logging import Logger, getLogger
+from urllib.parse import urlsplit
+
+from chat.tools.search import TavilyResultItem, TavilySearchResults
+
+logging: Logger = getLogger(__name__)
+
+__WORDS__ = re.compile(r'\w+')
+__SENTENCES__ = re.compile(r'(?<=[.!?])\s+|\n+')
+__STOP_WORDS__ = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'in', 'is', 'it', 'of',
+    'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who', 'why', 'with'
+))
+
+def __terms__(text: str) -> set[str]:
+    return {word for word in __WORDS__.findall(text.lower()) if word not in __STOP_WORDS__}
+
+def __shingles__(text: str, size: int = 3) -> set[tuple[str, ...]]:
+    words = __WORDS__.findall(text.lower())
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def __url_key__(url: str) -> str:
+    parts = urlsplit(url)
+    host = parts.netloc.lower().removeprefix('www.')
+    return f'{host}{parts.path.rstrip("/")}?{parts.query}'
+
+class SearchCompactor():
+    """Shrinks the search results before they are sent back to the model, and kept in the chat history.
+
+    Near-identical results are dropped, and the content of the rest is cut to the sentences most
+    relevant to the query, so that all the results fit in `token_budget` tokens.
+    """
+    token_budget: int
+    similarity: float
+    min_excerpt_size = 200
+    chars_per_token = 4
+
+    def __init__(self, token_budget: int = 1000, similarity: float = 0.8) -> None:
+        self.token_budget = token_budget
+        self.similarity = similarity
+
+    def __dedupe__(self, results: list[TavilyResultItem]) -> list[TavilyResultItem]:
+        kept: list[tuple[TavilyResultItem, set[tuple[str, ...]]]] = []
+        urls: set[str] = set()
+        # the best scored copy of a result is kept
+        for result in sorted(results, key=lambda result: result.score, reverse=True):
+            url = __url_key__(result.url)
+            shingles = __shingles__(result.content)
+            if url in urls or any(len(shingles & other) / len(shingles | other) >= self.similarity for _, other in kept):
+                continue
+            urls.add(url)
+            kept.append((result, shingles))
+        return [result for result, _ in kept]
+
+    def __excerpt__(self, content: str, terms: set[str], size: int) -> str:
+        if len(content) <= size:
+            return content
+
+        sentences = [sentence.strip() for sentence in __SENTENCES__.split(content) if sentence.strip()]
+        # rank by the query terms covered, the earlier sentences win the ties
+        ranked = sorted(range(len(sentences)), key=lambda i: (-len(__terms__(sentences[i]) & terms), i))
+        picked: list[int] = []
+        used = 0
+        for i in ranked:
+            if used + len(sentences[i]) > size:
+                continue
+            picked.append(i)
+            used += len(sentences[i]) + 1
+        if len(picked) == 0:
+            return content[:size].rsplit(' ', 1)[0] + '…'
+        return ' '.join(sentences[i] for i in sorted(picked))
+
+    def compact(self, result: TavilySearchResults) -> TavilySearchResults:
+        terms = __terms__(result.query)
+        results = self.__dedupe__(result.results)
+
+        budget = self.token_budget * self.chars_per_token - len(result.answer)
+        # drop the least relevant results rather than cutting every excerpt to nothing
+        while len(results) > 1 and budget // len(results) < self.min_excerpt_size:
+            results.pop()
+        size = max(budget // max(len(results), 1), self.min_excerpt_size)
+
+        compacted = TavilySearchResults(
+            query=result.query,
+            answer=result.answer,
+            results=[
+                TavilyResultItem(title=item.title, url=item.url, score=item.score, content=self.__excerpt__(item.content, terms, size))
+                for item in results
+            ]
+        )
+        logging.debug(f'Compacted {len(result.results)} search results to {len(compacted.results)}, {sum(len(item.content) for item in result.results)} -> {sum(len(item.content) for item in compacted.results)} chars')
+        return compacted
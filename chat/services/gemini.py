@@ -7,6 +7,7 @@ from google.genai.chats import AsyncChat
 from pydantic import ValidationError
 
 
+from chat.blob_store import BlobStore
 from chat.prompts.static import SYSTEM_INSTRUCTIONS
 from chat.tools.generation import GenerateImageFunctionDeclaration, GenerateVoiceFunctionDeclaration, GenerateImageFunctionCall, GenerateVoiceFunctionCall
 from chat.tools.search import TavilySearchFunctionDeclaration, TavilySearchFunctionCall
@@ -45,8 +46,9 @@ class GeminiService(object):
         ],
     )
     client: AsyncClient
+    blobs: BlobStore
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, blobs: BlobStore):
         api_client=ApiClient(
             api_key=api_key,
         )
@@ -54,6 +56,7 @@ class GeminiService(object):
             'api_version': 'v1alpha'
         })
         self.client = AsyncClient(api_client=api_client)
+        self.blobs = blobs
 
     def __parse_function_call__(self, function_call: FunctionCall):
         try:
@@ -72,33 +75,65 @@ class GeminiService(object):
         except ValidationError as e:
             logging.warning(f"Failed to parse function call: {e}")
 
-    async def gen_response_stream(self, prompts: list[PartUnionDict], chat: AsyncChat, function_response: FunctionResponse | None = None):
+    async def gen_response_stream(self, prompts: list[PartUnionDict], chat: AsyncChat, function_responses: list[FunctionResponse] = []):
         try:
-            if function_response:
-                prompts = [*prompts, Part(function_response=function_response)]
-            response = await chat.send_message(prompts)
-        
-            if response.candidates and (content := response.candidates[0].content) is not None and content.parts:
-                for part in content.parts:
-                    if part.text:
-                        yield part.text
-                    elif part.function_call:
-                        part.function_call = self.__parse_function_call__(part.function_call)
-                        yield part.function_call
+            if function_responses:
+                prompts = [*prompts, *(Part(function_response=response) for response in function_responses)]
+            function_calls: list[FunctionCall | None] = []
+            history = chat._curated_history
+            history_size = len(history)
+
+            # the history holds references to the media, the request is made with a resolved copy of it
+            chat._curated_history = await self.blobs.resolve(history)
+            try:
+                async for response in chat.send_message_stream(prompts):
+                    if response.candidates and (content := response.candidates[0].content) is not None and content.parts:
+                        for part in content.parts:
+                            if part.text:
+                                yield part.text
+                            elif part.function_call:
+                                # the history keeps the plain call with dict args, which serializes cleanly
+                                function_call = self.__parse_function_call__(part.function_call)
+                                if function_call is None:
+                                    part.function_call = None
+                                function_calls.append(function_call)
+            finally:
+                history.extend(chat._curated_history[history_size:])
+                chat._curated_history = history
+
+            self.__merge_text_chunks__(chat, history_size)
+
+            # the chat history is updated once the stream is complete,
+            # so function calls are yielded only after that to let them be replaced in the history
+            for function_call in function_calls:
+                yield function_call
 
         except StopAsyncIteration:
             # Handle the StopAsyncIteration exception, raised by async generators, here
             pass
 
+    def __merge_text_chunks__(self, chat: AsyncChat, start: int):
+        # every streamed chunk is added to the history as a separate content, join the consecutive text ones
+        history = chat._curated_history
+        merged: list[Content] = []
+        for content in history[start:]:
+            is_text = content.role == 'model' and content.parts and all(part.text is not None for part in content.parts)
+            if is_text and merged and merged[-1].role == 'model' and merged[-1].parts and all(part.text is not None for part in merged[-1].parts):
+                merged[-1].parts = [Part(text=''.join(part.text or '' for part in [*merged[-1].parts, *content.parts]))]
+            else:
+                merged.append(content)
+        history[start:] = merged
+
     def function_call_replace(self, result: list[Part], function_call: FunctionCall, chat: AsyncChat):
         history = chat._curated_history
 
-        for content in history:
-            if content.parts and content.parts[0].function_call:
-                call = content.parts[0].function_call
-                if call.name == function_call.name and call.id == function_call.id:
-                    content.parts = result
-                    break
+        for content in reversed(history):
+            for i, part in enumerate(content.parts or []):
+                call = part.function_call
+                if call and call.name == function_call.name and call.id == function_call.id:
+                    # a content may hold several calls, replace only the matching one
+                    content.parts[i:i + 1] = result
+                    return
 
     def create_chat_session(self, history: list[Content] = []):
         return self.client.chats.create(
@@ -1,11 +1,15 @@
 import asyncio
+import random
 import aiohttp
 from google.genai.types import Blob
 from logging import Logger, getLogger
 from typing import Literal
-import pollinations
+from urllib.parse import quote
+from pollinations import API
 from pydantic import BaseModel
 
+from common.types.exceptions import FileSizeTooBigException
+
 logging: Logger = getLogger(__name__)
 
 class ImageResponse(BaseModel):
@@ -14,22 +18,52 @@ class ImageResponse(BaseModel):
 
 class ImgGenService():
     __name__ = "ImgGenService"
-    client: pollinations.Async.Image
+    __session: aiohttp.ClientSession | None
+    __max_size: int
+    chunk_size = 64 * 1024
+
+    def __init__(self, max_size: int = 10 * 1024 * 1024) -> None:
+        self.__session = None
+        self.__max_size = max_size
+
+    def __get_session__(self):
+        # one pooled session for the lifetime of the service, created in the running loop
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(
+                headers=API.HEADERS.value,
+                timeout=aiohttp.ClientTimeout(total=API.TIMEOUT.value)
+            )
+        return self.__session
 
-    def __init__(self) -> None:
-        self.client = pollinations.Async.Image()
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+
+    async def __req_image__(self, prompt: str, params: dict[str, str | int]):
+        # the image is generated by the GET request itself, so the body is kept rather than fetched again
+        url = f"https://{API.IMAGE.value}/prompt/{quote(prompt, safe='')}"
+        try:
+            async with self.__get_session__().get(url, params=params) as response:
+                response.raise_for_status()
+                if response.content_length and response.content_length > self.__max_size:
+                    raise FileSizeTooBigException(f'Image of {response.content_length} bytes is too big')
+
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    data.extend(chunk)
+                    if len(data) > self.__max_size:
+                        raise FileSizeTooBigException(f'Image is bigger than {self.__max_size} bytes')
 
-    async def __req_image__(self, image_request: pollinations.Async.Image.Request):
-        request = await image_request()
-        if request.response:
-            async with aiohttp.ClientSession() as session, session.get(request.response.url) as response:
                 return ImageResponse(
-                    url=str(request.response.url),
+                    url=str(response.url),
                     blob=Blob(
                         mime_type=response.content_type,
-                        data=await response.content.read()
+                        data=bytes(data)
                     )
                 )
+        except (aiohttp.ClientError, asyncio.TimeoutError, FileSizeTooBigException) as e:
+            logging.warning(f'Failed to generate image: {e}')
+            return None
 
     async def gen_image_response(
         self,
@@ -48,20 +82,20 @@ class ImgGenService():
         elif quality == "HIGH":
             height = 2048
             width = 2048
-        
+
         for _ in range(quantity):
             image_requests.append(
-                self.__req_image__(pollinations.Async.Image.Request(
-                    model='flux-pro',
-                    prompt=prompt,
-                    seed="random",
-                    width=width,
-                    height=height,
-                    enhance=False,
-                    nologo=True,
-                    private=True,
-                    safe=False
-                ))
+                self.__req_image__(prompt, {
+                    'model': 'flux-pro',
+                    'seed': random.randint(1, 999999999),
+                    'width': width,
+                    'height': height,
+                    'enhance': 'false',
+                    'nologo': 'true',
+                    'private': 'true',
+                    'safe': 'false',
+                    'referrer': 'gemi-bot'
+                })
             )
 
         images = await asyncio.gather(*image_requests)
@@ -69,5 +103,5 @@ class ImgGenService():
 
         if len(images) == 0:
             raise Exception('No images generated, try something else!')
-        
-        return images
\ No newline at end of file
+
+        return images
@@ -2,20 +2,36 @@ from logging import Logger, getLogger
 from typing import Literal
 from tavily import AsyncTavilyClient
 
+from utils.ttl_cache import TTLCache
+
 
 logging: Logger = getLogger(__name__)
 
 class TavilyService:
     client: AsyncTavilyClient
+    cache: TTLCache[tuple[str, str, int], dict]
+    __ttls: dict[str, float]
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_size: int = 256, cache_ttl: float = 3600, news_cache_ttl: float = 300):
         self.client = AsyncTavilyClient(api_key=api_key)
+        self.cache = TTLCache(capacity=cache_size, ttl=cache_ttl)
+        # news go stale much sooner than the general results
+        self.__ttls = { 'general': cache_ttl, 'news': news_cache_ttl }
 
     async def search(self, query: str, max_results: int = 1, topic: Literal['general', 'news'] = 'general'):
-        logging.debug(f"Tavily search query: {query}")
-        return await self.client.search(
-            query=query,
-            topic=topic,
-            max_results=max_results,
-            include_answer=True
-        )
\ No newline at end of file
+        # the same question is often asked with a different casing or spacing
+        key = (' '.join(query.lower().split()), topic, max_results)
+
+        async def search():
+            logging.debug(f"Tavily search query: {query}")
+            return await self.client.search(
+                query=query,
+                topic=topic,
+                max_results=max_results,
+                include_answer=True
+            )
+
+        return await self.cache.get_or_load(key, search, ttl=self.__ttls.get(topic))
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,75 @@
+import asyncio
+from abc import ABC, abstractmethod
+from google.genai.types import Blob
+from groq import AsyncGroq
+from logging import Logger, getLogger
+
+logging: Logger = getLogger(__name__)
+
+class SpeechToTextBackend(ABC):
+    """Turns speech into text, subclassed by every transcription provider."""
+
+    @abstractmethod
+    async def transcribe(self, data: bytes, mime_type: str) -> str:
+        ...
+
+    async def close(self):
+        pass
+
+class GroqSpeechToText(SpeechToTextBackend):
+    __groq: AsyncGroq
+    __model: str
+
+    def __init__(self, api_key: str, model: str = 'whisper-large-v3-turbo'):
+        self.__groq = AsyncGroq(api_key=api_key)
+        self.__model = model
+
+    async def transcribe(self, data: bytes, mime_type: str) -> str:
+        # the file name tells the format of the audio
+        file_name = f"voice.{mime_type.split('/')[-1]}"
+        transcription = await self.__groq.audio.transcriptions.create(model=self.__model, file=(file_name, data))
+        return transcription.text.strip()
+
+    async def close(self):
+        await self.__groq.close()
+
+class StaticSpeechToText(SpeechToTextBackend):
+    """Stand-in backend which doesn't call any provider, for local runs and tests."""
+    __text: str
+
+    def __init__(self, text: str = 'This is a transcription of the voice message.'):
+        self.__text = text
+
+    async def transcribe(self, data: bytes, mime_type: str) -> str:
+        return self.__text
+
+class TranscriptionService:
+    backend: SpeechToTextBackend | None
+    keep_audio: bool
+    __timeout: float
+
+    def __init__(self, backend: SpeechToTextBackend | None, keep_audio: bool = False, timeout: float = 30):
+        self.backend = backend
+        self.keep_audio = keep_audio
+        self.__timeout = timeout
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    async def transcribe(self, blob: Blob) -> str | None:
+        """
+        Returns the transcription of the audio, or None if it can't be transcribed.
+        """
+        if self.backend is None or not blob.data:
+            return None
+        try:
+            async with asyncio.timeout(self.__timeout):
+                return await self.backend.transcribe(blob.data, blob.mime_type or 'audio/ogg')
+        except Exception as e:
+            logging.warning(f'Failed to transcribe the voice: {type(e).__name__}: {e}')
+            return None
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
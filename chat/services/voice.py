@@ -1,57 +1,191 @@
 import asyncio
+import hashlib
+import re
+import time
 from typing import Literal
 from google.genai.types import Blob
-from groq import AsyncGroq
+from groq import AsyncGroq, RateLimitError
 from logging import getLogger
 from pydantic import BaseModel
 
-from common.types.exceptions import FeatureNotEnabledException
+from common.types.exceptions import FeatureNotEnabledException, ServiceOverloadedException
+from utils.audio import concat_wav, encode_ogg_opus
+from utils.disk_cache import DiskCache
+from utils.fair_queue import FairQueue
+from utils.ttl_cache import TTLCache
 
 logging = getLogger(__name__)
 
+__DURATION__ = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+__UNITS__ = { 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600 }
+__SENTENCE_END__ = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+def __split_sentences__(text: str, max_size: int) -> list[str]:
+    # consecutive sentences are packed together, a sentence longer than max_size is kept whole
+    chunks: list[str] = []
+    for sentence in __SENTENCE_END__.split(text):
+        if not (sentence := sentence.strip()):
+            continue
+        if chunks and len(chunks[-1]) + len(sentence) + 1 <= max_size:
+            chunks[-1] = f'{chunks[-1]} {sentence}'
+        else:
+            chunks.append(sentence)
+    return chunks
+
+def __parse_duration__(value: str | None) -> float:
+    # Groq sends the rate limit resets as "1m30.5s", "120ms" etc.
+    if not value:
+        return 0
+    try:
+        return float(value)
+    except ValueError:
+        return sum(float(amount) * __UNITS__[unit] for amount, unit in __DURATION__.findall(value))
+
 class VoiceResponse(BaseModel):
     data: bytes
     blob: Blob
 
 class VoiceService:
-    __engine_busy_sem = asyncio.BoundedSemaphore(1)
     __groq: AsyncGroq | None = None
     __model: str
     __voice: str
     __response_format: Literal['flac', 'mp3', 'mulaw', 'ogg', 'wav']
-    
-    def __init__(self, groq_api_key: str | None, tts_model: str, tts_voice: str):
+    __queue: FairQueue[int]
+    __timeout: float
+    __paused_until: float
+    __cache: TTLCache[str, VoiceResponse]
+    __disk_cache: DiskCache | None
+    __chunk_size: int
+
+    def __init__(self, groq_api_key: str | None, tts_model: str, tts_voice: str, concurrency: int = 4, queue_size: int = 10, timeout: float = 30, cache_path: str = 'data/tts', cache_size: int = 100 * 1024 * 1024, memory_cache_size: int = 32, chunk_size: int = 400):
         self.__groq = AsyncGroq(api_key=groq_api_key) if groq_api_key else None
         self.__model = tts_model
         self.__voice = tts_voice
         self.__response_format = 'wav'
+        # a chat can't hold more than half of the workers, the others are served in turns
+        self.__queue = FairQueue(concurrency=concurrency, per_key_limit=max(concurrency // 2, 1), max_queued=queue_size, max_queued_per_key=max(queue_size // 2, 1), priority_slots=0)
+        self.__timeout = timeout
+        self.__paused_until = 0
+        # the same texts are voiced over and over, e.g. greetings and retries
+        self.__cache = TTLCache(capacity=memory_cache_size, ttl=float('inf'))
+        self.__disk_cache = DiskCache(cache_path, max_bytes=cache_size) if cache_path else None
+        self.__chunk_size = chunk_size
 
     async def close(self):
         return await self.__groq.close() if self.__groq else None
 
-    async def text_to_wave(self, text: str) -> VoiceResponse:
+    def __pause__(self, seconds: float):
+        if seconds > 0:
+            logging.warning(f'TTS rate limit reached, pausing for {seconds:.1f}s')
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    async def __synthesize__(self, text: str):
+        assert self.__groq
+        # wait out the provider's rate limit rather than getting rejected
+        if (delay := self.__paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+        try:
+            response = await self.__groq.audio.speech.create(
+                model=self.__model,
+                voice=self.__voice,
+                input=text,
+                response_format=self.__response_format
+            )
+        except RateLimitError as e:
+            self.__pause__(__parse_duration__(e.response.headers.get('retry-after')))
+            raise ServiceOverloadedException('TTS rate limit reached') from e
+
+        if response.headers.get('x-ratelimit-remaining-requests') == '0':
+            self.__pause__(__parse_duration__(response.headers.get('x-ratelimit-reset-requests')))
+        data = await response.read()
+
+        return VoiceResponse(
+            data=data,
+            blob=Blob(
+                data=data,
+                mime_type=response.headers.get("Content-Type", f'audio/{self.__response_format}')
+            )
+        )
+
+    def __cache_key__(self, text: str):
+        key = '\0'.join((' '.join(text.split()), self.__model, self.__voice, self.__response_format))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def __generate__(self, text: str, key: int, cache_key: str, bounded: bool) -> VoiceResponse:
+        if self.__disk_cache is not None and (data := await asyncio.to_thread(self.__disk_cache.get, cache_key)) is not None:
+            return VoiceResponse(data=data, blob=Blob(data=data, mime_type=f'audio/{self.__response_format}'))
+
+        started = time.monotonic()
+        async with asyncio.timeout(self.__timeout):
+            async with self.__queue.slot(key, bounded=bounded):
+                waited = time.monotonic() - started
+                if waited > 1:
+                    logging.info(f'TTS request of {key} waited {waited:.1f}s for a worker')
+                try:
+                    response = await self.__synthesize__(text)
+                except ServiceOverloadedException:
+                    raise
+                except Exception as e:
+                    logging.error(f"Error in text_to_wave: {e}", exc_info=True)
+                    raise e
+
+        if self.__disk_cache is not None:
+            try:
+                await asyncio.to_thread(self.__disk_cache.put, cache_key, response.data)
+            except OSError as e:
+                logging.warning(f'Failed to cache the voice: {e}')
+        return response
+
+    async def text_to_wave(self, text: str, key: int = 0, bounded: bool = True) -> VoiceResponse:
+        """
+        Synthesizes the text on a worker of the pool, `key` is the chat the workers are shared fairly between.
+        The voices are cached, concurrent requests of the same text share a single synthesis.
+
+        Raises :class:`ServiceOverloadedException` if too many requests are waiting, unless the request is not
+        `bounded`, and :class:`TimeoutError` if the request isn't served in time.
+        """
         if not self.__groq:
             raise FeatureNotEnabledException("Voice generation is not enabled.")
         if not text or text.isspace():
             raise ValueError("Text cannot be empty")
 
-        async with self.__engine_busy_sem:
-            try:
-                response = await self.__groq.audio.speech.create(
-                    model=self.__model,
-                    voice=self.__voice,
-                    input=text,
-                    response_format=self.__response_format
-                )
-                data = await response.read()
-
-                return VoiceResponse(
-                    data=data,
-                    blob=Blob(
-                        data=data,
-                        mime_type=response.headers.get("Content-Type", f'audio/{self.__response_format}')
-                    )
-                )
-            except Exception as e:
-                logging.error(f"Error in text_to_wave: {e}", exc_info=True)
-                raise e
+        cache_key = self.__cache_key__(text)
+        return await self.__cache.get_or_load(cache_key, lambda: self.__generate__(text, key, cache_key, bounded))
+
+    async def text_to_voice(self, text: str, key: int = 0) -> VoiceResponse:
+        """
+        Synthesizes the sentences of the text concurrently and joins them in order, the voice is encoded
+        to OGG/Opus if ffmpeg is available, WAV otherwise.
+        """
+        if not self.__groq:
+            raise FeatureNotEnabledException("Voice generation is not enabled.")
+        chunks = __split_sentences__(text, self.__chunk_size) if self.__chunk_size > 0 else [text]
+        # the voice is admitted as a whole, its chunks still take a worker each but are never rejected,
+        # a long text would otherwise run into the queue limits of the chat by itself
+        self.__queue.admit(key)
+        tasks = [asyncio.create_task(self.text_to_wave(chunk, key, bounded=False)) for chunk in chunks or [text]]
+        try:
+            waves = await asyncio.gather(*tasks)
+        finally:
+            # a failed chunk fails the whole voice
+            for task in tasks:
+                task.cancel()
+
+        try:
+            wav = concat_wav([wave.data for wave in waves])
+        except ValueError as e:
+            logging.warning(f'Failed to join the voice chunks, synthesizing it at once: {e}')
+            wav = (await self.text_to_wave(text, key, bounded=False)).data
+
+        if (ogg := await encode_ogg_opus(wav)) is not None:
+            return VoiceResponse(data=ogg, blob=Blob(data=ogg, mime_type='audio/ogg'))
+        return VoiceResponse(data=wav, blob=Blob(data=wav, mime_type=f'audio/{self.__response_format}'))
+
+    def stats(self):
+        return {
+            **self.__queue.stats(),
+            'paused_for': max(self.__paused_until - time.monotonic(), 0),
+            'cache': self.__cache.stats(),
+            'disk_cache': self.__disk_cache.stats() if self.__disk_cache else None,
+        }
@@ -0,0 +1,95 @@
+import asyncio
+import pickle
+import sqlite3
+import threading
+import time
+from logging import Logger, getLogger
+from os import makedirs, path
+from google.genai.types import Content
+
+from chat.blob_store import parse_blob_uri
+
+logging: Logger = getLogger(__name__)
+
+class ChatStore():
+    """SQLite backed store for chat histories which are not kept in memory."""
+    __path: str
+    __conn: sqlite3.Connection | None
+    __lock: threading.Lock
+
+    def __init__(self, path: str = 'data/chats.db') -> None:
+        self.__path = path
+        self.__conn = None
+        self.__lock = threading.Lock()
+
+    def __connect__(self):
+        if self.__conn is None:
+            if (dir := path.dirname(self.__path)) != '':
+                makedirs(dir, exist_ok=True)
+            self.__conn = sqlite3.connect(self.__path, check_same_thread=False)
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, history BLOB NOT NULL, updated_at REAL NOT NULL)')
+            self.__conn.commit()
+        return self.__conn
+
+    def __load__(self, chat_id: int):
+        with self.__lock:
+            row = self.__connect__().execute('SELECT history FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return None
+        return [Content.model_validate(content) for content in pickle.loads(row[0])]
+
+    def __save__(self, chats: list[tuple[int, bytes]]):
+        with self.__lock:
+            conn = self.__connect__()
+            conn.executemany('INSERT OR REPLACE INTO chats (id, history, updated_at) VALUES (?, ?, ?)', [(id, data, time.time()) for id, data in chats])
+            conn.commit()
+
+    def __blob_refs__(self) -> set[str]:
+        with self.__lock:
+            rows = self.__connect__().execute('SELECT history FROM chats').fetchall()
+        # the dumps are walked as they are, validating every history is much slower
+        refs: set[str] = set()
+        for row in rows:
+            for content in pickle.loads(row[0]):
+                for part in content.get('parts') or []:
+                    uri = (part.get('file_data') or {}).get('file_uri')
+                    if uri and (ref := parse_blob_uri(uri)) is not None:
+                        refs.add(ref[0])
+        return refs
+
+    def __dump__(self, history: list[Content]):
+        return pickle.dumps([content.model_dump(exclude_none=True) for content in history])
+
+    async def load(self, chat_id: int) -> list[Content] | None:
+        try:
+            return await asyncio.to_thread(self.__load__, chat_id)
+        except Exception as e:
+            logging.error(f"Failed to load chat {chat_id}: {e}", exc_info=True)
+            return None
+
+    async def blob_refs(self) -> set[str] | None:
+        """Returns the digests of the blobs referred to by the stored histories, or None if they can't be read."""
+        try:
+            return await asyncio.to_thread(self.__blob_refs__)
+        except Exception as e:
+            logging.error(f"Failed to read the blob references: {e}", exc_info=True)
+            return None
+
+    async def save(self, chats: dict[int, list[Content]]) -> bool:
+        """Writes the histories of the chats, returns whether they were saved."""
+        if len(chats) == 0:
+            return True
+        try:
+            # serialize in the caller's thread, the histories might change once we yield
+            dumps = [(id, self.__dump__(history)) for id, history in chats.items()]
+            await asyncio.to_thread(self.__save__, dumps)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to save {len(chats)} chats: {e}", exc_info=True)
+            return False
+
+    def close(self):
+        with self.__lock:
+            if self.__conn is not None:
+                self.__conn.close()
+                self.__conn = None
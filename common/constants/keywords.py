@@ -1,4 +1,6 @@
 MESSAGE_METADATA = 'message_metadata'
+CONVERSATION_SUMMARY = 'conversation_summary'
+VOICE_TRANSCRIPT = 'voice_transcript'
 SEARCH_QUERIES = 'search_queries'
 SEARCH_RESPONSES = 'search_responses'
 IMAGE_QUERY = 'image_query'
@@ -4,4 +4,9 @@ from enum import Enum
 class BotEventMethods(Enum):
     webhook = 1
     polling = 2
-    unknown = 3
\ No newline at end of file
+    unknown = 3
+class SupersedePolicy(Enum):
+    # the messages of a chat are answered one after the other
+    none = 'none'
+    # a newer message of a chat aborts the answer in progress, both are answered together
+    newer = 'newer'
@@ -5,4 +5,9 @@ class FileSizeTooBigException(Exception):
     pass
 
 class FeatureNotEnabledException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class ServiceOverloadedException(Exception):
+    pass
+class TurnSupersededException(Exception):
+    pass
@@ -2,9 +2,14 @@ from dependency_injector import providers, containers
 from bot.bot import TgBot
 from chat.services.img_gen import ImgGenService
 from chat.query_processor import QueryProcessor
+from chat.blob_store import BlobStore
+from chat.history import HistoryManager
+from chat.search_compactor import SearchCompactor
 from chat.repository import ChatRepo
+from chat.store import ChatStore
 from chat.services.gemini import GeminiService
 from chat.services.tavily import TavilyService
+from chat.services.transcription import GroqSpeechToText, StaticSpeechToText, TranscriptionService
 from chat.services.voice import VoiceService
 
 class Configs(containers.DeclarativeContainer):
@@ -12,10 +17,21 @@ class Configs(containers.DeclarativeContainer):
     chat_config = providers.Configuration('chat')
 
 class BotContainer(containers.DeclarativeContainer):
-    chat_service = providers.Singleton(GeminiService, api_key=Configs.chat_config.api_key)
-    voice_service = providers.Singleton(VoiceService, groq_api_key=Configs.chat_config.groq_api_key, tts_model=Configs.chat_config.tts_model, tts_voice=Configs.chat_config.tts_voice)
-    img_service = providers.Singleton(ImgGenService)
-    tavily_service = providers.Singleton(TavilyService, api_key=Configs.chat_config.tavily_api_key)
-    query_processor = providers.Singleton(QueryProcessor, gemini=chat_service, voice=voice_service, img_gen=img_service, tavily=tavily_service)
-    chat_repo = providers.Factory(ChatRepo, gemini=chat_service, processor=query_processor)
-    tg_bot = providers.Singleton(TgBot, token=Configs.bot_config.token, chat_repo=chat_repo, voice_service=voice_service, webhook_host=Configs.bot_config.webhook_host, webhook_secret=Configs.bot_config.webhook_secret)
+    blob_store = providers.Singleton(BlobStore, path=Configs.chat_config.blob_store_path, memory_budget=Configs.chat_config.blob_cache_size)
+    chat_service = providers.Singleton(GeminiService, api_key=Configs.chat_config.api_key, blobs=blob_store)
+    voice_service = providers.Singleton(VoiceService, groq_api_key=Configs.chat_config.groq_api_key, tts_model=Configs.chat_config.tts_model, tts_voice=Configs.chat_config.tts_voice, concurrency=Configs.chat_config.tts_concurrency, queue_size=Configs.chat_config.tts_queue_size, timeout=Configs.chat_config.tts_timeout, cache_path=Configs.chat_config.tts_cache_path, cache_size=Configs.chat_config.tts_cache_size, chunk_size=Configs.chat_config.tts_chunk_size)
+    img_service = providers.Singleton(ImgGenService, max_size=Configs.chat_config.image_max_size)
+    tavily_service = providers.Singleton(TavilyService, api_key=Configs.chat_config.tavily_api_key, cache_size=Configs.chat_config.search_cache_size, cache_ttl=Configs.chat_config.search_cache_ttl, news_cache_ttl=Configs.chat_config.search_news_cache_ttl)
+    search_compactor = providers.Singleton(SearchCompactor, token_budget=Configs.chat_config.search_token_budget)
+    query_processor = providers.Singleton(QueryProcessor, gemini=chat_service, voice=voice_service, img_gen=img_service, tavily=tavily_service, compactor=search_compactor, history_image_size=Configs.chat_config.history_image_size)
+    history_manager = providers.Singleton(HistoryManager, token_budget=Configs.chat_config.history_token_budget, keep_turns=Configs.chat_config.history_keep_turns)
+    chat_store = providers.Singleton(ChatStore, path=Configs.chat_config.store_path)
+    chat_repo = providers.Singleton(ChatRepo, gemini=chat_service, processor=query_processor, history=history_manager, blobs=blob_store, store=chat_store, max_sessions=Configs.chat_config.max_sessions, idle_timeout=Configs.chat_config.idle_timeout, coalesce_window=Configs.chat_config.coalesce_window, supersede_policy=Configs.chat_config.supersede_policy, blob_sweep_interval=Configs.chat_config.blob_sweep_interval)
+    speech_to_text = providers.Selector(
+        Configs.chat_config.stt_backend,
+        none=providers.Object(None),
+        groq=providers.Singleton(GroqSpeechToText, api_key=Configs.chat_config.groq_api_key, model=Configs.chat_config.stt_model),
+        static=providers.Singleton(StaticSpeechToText),
+    )
+    transcription_service = providers.Singleton(TranscriptionService, backend=speech_to_text, keep_audio=Configs.chat_config.stt_keep_audio)
+    tg_bot = providers.Singleton(TgBot, token=Configs.bot_config.token, chat_repo=chat_repo, voice_service=voice_service, transcriber=transcription_service, webhook_host=Configs.bot_config.webhook_host, webhook_secret=Configs.bot_config.webhook_secret)
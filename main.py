@@ -9,6 +9,7 @@ from sentry_sdk.integrations.logging import LoggingIntegration
 from os import getenv, path
 from dotenv import load_dotenv
 
+from common.types.enums import SupersedePolicy
 from containers import BotContainer, Configs
 from api.routes import routes
 
@@ -67,13 +68,59 @@ def init_bot(app: Application):
     configs.chat_config.api_key.from_env("GOOGLE_API_KEY", required=True)
     # Tavily API key for live data search
     configs.chat_config.tavily_api_key.from_env("TAVILY_API_KEY", required=True)
+    # Search results are shared by the chats for a while, news for a shorter while
+    configs.chat_config.search_cache_size.from_env("SEARCH_CACHE_SIZE", as_=int, default=256)
+    configs.chat_config.search_cache_ttl.from_env("SEARCH_CACHE_TTL", as_=float, default=3600)
+    configs.chat_config.search_news_cache_ttl.from_env("SEARCH_NEWS_CACHE_TTL", as_=float, default=300)
+    # Approx. tokens of search results sent back to the model, and kept in the history
+    configs.chat_config.search_token_budget.from_env("SEARCH_TOKEN_BUDGET", as_=int, default=1000)
     # Groq API key for voice generation
     configs.chat_config.groq_api_key.from_env("GROQ_API_KEY", required=True)
     # TTS model and voice to use
     configs.chat_config.tts_model.from_env("TTS_MODEL", default="playai-tts")
     configs.chat_config.tts_voice.from_env("TTS_VOICE", default="Gail-PlayAI")
+    # Voices synthesized at a time, the requests above the queue size are answered with text
+    configs.chat_config.tts_concurrency.from_env("TTS_CONCURRENCY", as_=int, default=4)
+    configs.chat_config.tts_queue_size.from_env("TTS_QUEUE_SIZE", as_=int, default=10)
+    configs.chat_config.tts_timeout.from_env("TTS_TIMEOUT", as_=float, default=30)
+    # Max characters of the sentences synthesized together, the chunks are synthesized concurrently (0 disables it)
+    configs.chat_config.tts_chunk_size.from_env("TTS_CHUNK_SIZE", as_=int, default=400)
+    # Synthesized voices are reused for the same text, the disk cache is disabled if the path is empty
+    configs.chat_config.tts_cache_path.from_env("TTS_CACHE_PATH", default="data/tts")
+    configs.chat_config.tts_cache_size.from_env("TTS_CACHE_SIZE", as_=int, default=100 * 1024 * 1024)
+    # Transcribe the voice messages before sending them to the model, "none", "groq" or "static" (a stand-in for tests)
+    configs.chat_config.stt_backend.from_env("STT_BACKEND", default="none")
+    configs.chat_config.stt_model.from_env("STT_MODEL", default="whisper-large-v3-turbo")
+    # Send the audio along with its transcript for the turn it was sent in, only the transcript is kept in the history
+    configs.chat_config.stt_keep_audio.from_env("STT_KEEP_AUDIO", as_=lambda value: value.lower() in ('1', 'true'), default="0")
+    # Max bytes of a generated image
+    configs.chat_config.image_max_size.from_env("IMAGE_MAX_SIZE", as_=int, default=10 * 1024 * 1024)
+    # Chat sessions kept in memory, the cold ones are persisted to the store
+    configs.chat_config.store_path.from_env("CHAT_STORE_PATH", default="data/chats.db")
+    configs.chat_config.max_sessions.from_env("CHAT_MAX_SESSIONS", as_=int, default=100)
+    configs.chat_config.idle_timeout.from_env("CHAT_IDLE_TIMEOUT", as_=float, default=1800)
+    # Media of the chat histories, stored once on disk and cached in memory
+    configs.chat_config.blob_store_path.from_env("BLOB_STORE_PATH", default="data/blobs")
+    configs.chat_config.blob_cache_size.from_env("BLOB_CACHE_SIZE", as_=int, default=32 * 1024 * 1024)
+    # Seconds between the sweeps deleting the media no chat history refers to anymore (0 disables them)
+    configs.chat_config.blob_sweep_interval.from_env("BLOB_SWEEP_INTERVAL", as_=float, default=6 * 3600)
+    # Token budget of the history resent on every message, older turns are summarized
+    configs.chat_config.history_token_budget.from_env("HISTORY_TOKEN_BUDGET", as_=int, default=16000)
+    configs.chat_config.history_keep_turns.from_env("HISTORY_KEEP_TURNS", as_=int, default=4)
+    # Max pixels on the longest side of the generated images kept in the history
+    configs.chat_config.history_image_size.from_env("HISTORY_IMAGE_SIZE", as_=int, default=384)
+    # Seconds to wait for more messages of a chat, to answer a burst of messages at once (0 disables it)
+    configs.chat_config.coalesce_window.from_env("MSG_COALESCE_WINDOW", as_=float, default=0)
+    # "newer" aborts the answer in progress when a newer message of the chat arrives, "none" answers every message
+    configs.chat_config.supersede_policy.from_env("MSG_SUPERSEDE_POLICY", as_=SupersedePolicy, default="none")
 
     BotContainer.tg_bot().register_webhook_handler(app, WEBHOOK_PATH)
+    app.on_cleanup.append(close_services)
+
+async def close_services(_: Application):
+    await BotContainer.img_service().close()
+    await BotContainer.voice_service().close()
+    await BotContainer.transcription_service().close()
 
 async def web_app():
     if path.exists(".env"):
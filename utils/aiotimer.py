@@ -3,56 +3,129 @@ Timer support for asyncio.
 """
 
 import asyncio
+import heapq
+import itertools
+from logging import Logger, getLogger
+
+logging: Logger = getLogger(__name__)
+
+class Deadline:
+    __slots__ = ('when', 'callback', 'args', 'done')
+
+    def __init__(self, when: float, callback, args: tuple):
+        """A callback scheduled on the :class:`DeadlineScheduler`.
 
-class Timer:
-    def __init__(self, timeout : float, callback, callback_args = (), callback_kwargs = {}):
-        """An asynchronous Timer object.
-        
         Parameters
         -----------
-        timeout: :class:`float`:
-        The duration for which the timer should last.
+        when: :class:`float`:
+        The loop time at which the callback is called.
 
         callback: :class:`Coroutine` or `Method`:
-        An `asyncio` coroutine or a regular method that will be called as soon as the timer ends.
+        An `asyncio` coroutine or a regular method that will be called at the deadline.
 
-        callback_args: Optional[:class:`tuple`]:
+        args: :class:`tuple`:
         The args to be passed to the callback.
+        """
+        self.when = when
+        self.callback = callback
+        self.args = args
+        # set once the callback is called or cancelled
+        self.done = False
+
+class DeadlineScheduler:
+    def __init__(self):
+        """A single task which calls the callbacks of all the deadlines, kept in a heap.
 
-        callback_kwargs: Optional[:class:`dict`]:
-        The kwargs to be passed to the callback. 
+        Scheduling is O(log n), cancelling is O(1), the cancelled deadlines are dropped lazily.
         """
-        self._timeout = timeout
-        self._callback = callback
-        self._task = asyncio.create_task(self._job())
-        self._callback_args = callback_args
-        self._callback_kwargs = callback_kwargs
-        
+        self._heap: list[tuple[float, int, Deadline]] = []
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._callback_tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
 
-    async def _job(self):
-        await asyncio.sleep(self._timeout)
-        await self._call_callback()
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
 
-    async def _call_callback(self):
-        res = self._callback(*self._callback_args, **self._callback_kwargs)
-        if asyncio.iscoroutine(res):
-            await res
+    async def _run(self):
+        assert self._loop and self._wakeup
+        while True:
+            while self._heap and self._heap[0][2].done:
+                heapq.heappop(self._heap)
+                self._cancelled -= 1
 
-    def wait(self):
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            when, _, deadline = self._heap[0]
+            if when > self._loop.time():
+                # sleep until the earliest deadline, or until an earlier one is scheduled
+                handle = self._loop.call_at(when, self._wakeup.set)
+                await self._wakeup.wait()
+                handle.cancel()
+                continue
+
+            heapq.heappop(self._heap)
+            deadline.done = True
+            self._call(deadline)
+
+    def _call(self, deadline: Deadline):
+        try:
+            res = deadline.callback(*deadline.args)
+            if asyncio.iscoroutine(res):
+                task = asyncio.create_task(res)
+                self._callback_tasks.add(task)
+                task.add_done_callback(self._callback_tasks.discard)
+        except Exception as e:
+            logging.error(f'Deadline callback failed: {e}', exc_info=True)
+
+    def schedule(self, delay: float, callback, *args) -> Deadline:
         """
-        Waits until the timer ends.
+        Calls the callback after `delay` seconds.
         """
-        return self._task
+        self._ensure_running()
+        assert self._loop and self._wakeup
+        deadline = Deadline(self._loop.time() + delay, callback, args)
+        heapq.heappush(self._heap, (deadline.when, next(self._counter), deadline))
+        if self._heap[0][2] is deadline:
+            # the new deadline is the earliest one
+            self._wakeup.set()
+        return deadline
 
-    def cancel(self):
+    def cancel(self, deadline: Deadline | None):
         """
-        Cancels the timer. The callback will not be called.
+        Cancels the deadline, if it is not called yet.
         """
-        self._task.cancel()
- 
-    def end_early(self):
+        if deadline is None or deadline.done:
+            return
+        deadline.done = True
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+            # too many dead entries, rebuild the heap
+            self._heap = [entry for entry in self._heap if not entry[2].done]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def reschedule(self, deadline: Deadline | None, delay: float, callback=None, *args) -> Deadline:
         """
-        Ends the timer early, and calls the callback coroutine.
+        Moves the deadline to `delay` seconds from now, a new deadline is scheduled if it is None.
         """
-        self._task.cancel()
-        asyncio.create_task(self._call_callback())
+        if deadline is not None:
+            self.cancel(deadline)
+            callback = callback or deadline.callback
+            args = args or deadline.args
+        return self.schedule(delay, callback, *args)
+
+# the scheduler shared by the whole app
+scheduler = DeadlineScheduler()
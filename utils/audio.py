@@ -0,0 +1,75 @@
+"""
+Module that joins and encodes audio.
+"""
+
+import asyncio
+import shutil
+import struct
+from logging import Logger, getLogger
+
+logging: Logger = getLogger(__name__)
+
+FFMPEG = shutil.which('ffmpeg')
+
+def __wav_chunks__(wav: bytes):
+    if wav[:4] != b'RIFF' or wav[8:12] != b'WAVE':
+        raise ValueError('Not a WAV file')
+    pos = 12
+    while pos + 8 <= len(wav):
+        id = wav[pos:pos + 4]
+        size = struct.unpack('<I', wav[pos + 4:pos + 8])[0]
+        # a streamed WAV may not know its data size, the slice stops at the end anyway
+        yield id, wav[pos + 8:pos + 8 + size]
+        pos += 8 + size + (size & 1)
+
+def concat_wav(wavs: list[bytes]) -> bytes:
+    """
+    Joins WAV files of the same format into one, raises ValueError if they can't be joined.
+    """
+    if len(wavs) == 1:
+        return wavs[0]
+
+    fmt: bytes | None = None
+    data: list[bytes] = []
+    for wav in wavs:
+        chunks = dict(__wav_chunks__(wav))
+        if b'fmt ' not in chunks or b'data' not in chunks:
+            raise ValueError('Missing WAV chunks')
+        if fmt is None:
+            fmt = chunks[b'fmt ']
+        elif chunks[b'fmt '] != fmt:
+            raise ValueError('WAV files of different formats')
+        data.append(chunks[b'data'])
+
+    assert fmt is not None
+    body = b''.join(data)
+    pad = b'\0' if len(body) & 1 else b''
+    return b''.join((
+        b'RIFF', struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(body) + len(pad)), b'WAVE',
+        b'fmt ', struct.pack('<I', len(fmt)), fmt,
+        b'data', struct.pack('<I', len(body)), body, pad
+    ))
+
+async def encode_ogg_opus(audio: bytes, bitrate: str = '32k') -> bytes | None:
+    """
+    Encodes the audio to OGG/Opus, the format of Telegram voice notes.
+    Returns None if ffmpeg isn't installed or fails to encode it.
+    """
+    if FFMPEG is None:
+        return None
+
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+        '-c:a', 'libopus', '-b:a', bitrate, '-application', 'voip', '-f', 'ogg', 'pipe:1',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await process.communicate(audio)
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+
+    if process.returncode != 0:
+        logging.warning(f'Failed to encode the audio to ogg: {err.decode(errors="replace").strip()}')
+        return None
+    return out
@@ -0,0 +1,86 @@
+"""
+Size bounded LRU cache of files on disk.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from logging import Logger, getLogger
+
+logging: Logger = getLogger(__name__)
+
+class DiskCache:
+    def __init__(self, path: str, max_bytes: int = 100 * 1024 * 1024):
+        """A cache of byte strings kept as files in a directory, the least recently used ones are
+        removed once the files take more than `max_bytes`.
+
+        The methods do blocking IO, call them from a worker thread.
+
+        Parameters
+        -----------
+        path: :class:`str`:
+        Directory of the files, it is scanned on the first use so the cache survives restarts.
+
+        max_bytes: :class:`int`:
+        Max total size of the files.
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        # key -> size, in least recently used order
+        self._index: OrderedDict[str, int] | None = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _file(self, key: str):
+        return os.path.join(self._path, key)
+
+    def _ensure_index(self) -> OrderedDict[str, int]:
+        if self._index is None:
+            os.makedirs(self._path, exist_ok=True)
+            entries = [entry for entry in os.scandir(self._path) if entry.is_file() and not entry.name.endswith('.tmp')]
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            self._index = OrderedDict((entry.name, entry.stat().st_size) for entry in entries)
+            self._size = sum(self._index.values())
+        return self._index
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            index = self._ensure_index()
+            if key not in index:
+                return None
+            try:
+                with open(self._file(key), 'rb') as file:
+                    data = file.read()
+                # the mtime keeps the order of use across restarts
+                os.utime(self._file(key))
+            except OSError as e:
+                logging.warning(f'Failed to read cached file {key}: {e}')
+                self._size -= index.pop(key)
+                return None
+            index.move_to_end(key)
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            index = self._ensure_index()
+            with open(f'{self._file(key)}.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(f'{self._file(key)}.tmp', self._file(key))
+            self._size += len(data) - index.pop(key, 0)
+            index[key] = len(data)
+
+            while self._size > self._max_bytes and index:
+                evicted, size = index.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(self._file(evicted))
+                except OSError as e:
+                    logging.warning(f'Failed to remove cached file {evicted}: {e}')
+
+    def stats(self):
+        return {
+            'files': len(self._index or {}),
+            'bytes': self._size,
+        }
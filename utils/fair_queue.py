@@ -0,0 +1,198 @@
+"""
+Fair admission of concurrent work for asyncio.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Generic, Hashable, TypeVar
+
+from common.types.exceptions import ServiceOverloadedException
+
+K = TypeVar('K', bound=Hashable)
+
+class _Waiter(Generic[K]):
+    __slots__ = ('key', 'future', 'enqueued_at')
+
+    def __init__(self, key: K, future: asyncio.Future):
+        self.key = key
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+class FairQueue(Generic[K]):
+    def __init__(self, concurrency: int, per_key_limit: int = 1, max_queued: int = 100, max_queued_per_key: int = 10, priority_slots: int = 2, weights: dict[K, int] | None = None):
+        """Admits work in a weighted round robin order over the keys, so that a single key can't take every slot.
+
+        Parameters
+        -----------
+        concurrency: :class:`int`:
+        Max number of slots in use at a time.
+
+        per_key_limit: :class:`int`:
+        Max number of slots in use at a time by a single key.
+
+        max_queued: :class:`int`:
+        Max number of waiters, the work above it is rejected with :class:`ServiceOverloadedException`.
+
+        max_queued_per_key: :class:`int`:
+        Max number of waiters of a single key.
+
+        priority_slots: :class:`int`:
+        Extra slots reserved for the priority lane, which is always served first.
+
+        weights: Optional[:class:`dict`]:
+        Number of slots handed to a key in a single round, 1 by default.
+        """
+        self._concurrency = concurrency
+        self._per_key_limit = per_key_limit
+        self._max_queued = max_queued
+        self._max_queued_per_key = max_queued_per_key
+        self._priority_slots = priority_slots
+        self._weights = weights or {}
+        self._queues: dict[K, deque[_Waiter[K]]] = {}
+        # keys with waiters, in round robin order
+        self._round: deque[K] = deque()
+        self._priority: deque[_Waiter[K]] = deque()
+        self._credits: dict[K, int] = {}
+        self._running = 0
+        self._running_per_key: dict[K, int] = {}
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _can_run(self, key: K, priority: bool) -> bool:
+        limit = self._concurrency + (self._priority_slots if priority else 0)
+        if self._running >= limit:
+            return False
+        return priority or self._running_per_key.get(key, 0) < self._per_key_limit
+
+    def _grant(self, waiter: _Waiter[K]):
+        wait = time.monotonic() - waiter.enqueued_at
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        self._queued -= 1
+        self._start(waiter.key)
+        waiter.future.set_result(None)
+
+    def _start(self, key: K):
+        self._admitted += 1
+        self._running += 1
+        self._running_per_key[key] = self._running_per_key.get(key, 0) + 1
+
+    def _dispatch(self):
+        while self._priority and self._can_run(self._priority[0].key, True):
+            self._grant(self._priority.popleft())
+
+        # weighted round robin, a key which is at its limit keeps its turn for later
+        skipped = 0
+        while self._round and skipped < len(self._round) and self._running < self._concurrency:
+            key = self._round[0]
+            queue = self._queues[key]
+            if not self._can_run(key, False):
+                self._round.rotate(-1)
+                skipped += 1
+                continue
+
+            skipped = 0
+            self._grant(queue.popleft())
+            credits = self._credits.get(key, self._weights.get(key, 1)) - 1
+            if not queue:
+                del self._queues[key]
+                self._credits.pop(key, None)
+                self._round.popleft()
+            elif credits <= 0:
+                self._credits.pop(key, None)
+                self._round.rotate(-1)
+            else:
+                self._credits[key] = credits
+
+    def _remove(self, waiter: _Waiter[K], priority: bool):
+        self._queued -= 1
+        if priority:
+            self._priority.remove(waiter)
+            return
+        queue = self._queues[waiter.key]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.key]
+            self._credits.pop(waiter.key, None)
+            self._round.remove(waiter.key)
+
+    def _runs_now(self, key: K, priority: bool) -> bool:
+        return self._can_run(key, priority) and not self._priority and (priority or key not in self._queues)
+
+    def admit(self, key: K, priority: bool = False):
+        """
+        Raises :class:`ServiceOverloadedException` if a new waiter of the key would be rejected right now.
+        """
+        if self._runs_now(key, priority):
+            return
+        queue = self._queues.get(key)
+        if self._queued >= self._max_queued or (not priority and queue and len(queue) >= self._max_queued_per_key):
+            self._rejected += 1
+            raise ServiceOverloadedException('Too many pending requests')
+
+    async def acquire(self, key: K, priority: bool = False, bounded: bool = True):
+        """
+        Waits for a slot, raises :class:`ServiceOverloadedException` if there are too many waiters.
+
+        An unbounded waiter is never rejected, it is meant for the parts of a request which was admitted already.
+        """
+        if self._runs_now(key, priority):
+            self._start(key)
+            return
+
+        if bounded:
+            self.admit(key, priority)
+        queue = self._queues.get(key)
+
+        waiter = _Waiter(key, asyncio.get_running_loop().create_future())
+        self._queued += 1
+        if priority:
+            self._priority.append(waiter)
+        else:
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._round.append(key)
+            queue.append(waiter)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # the slot was granted right before the cancellation
+                self.release(key)
+            else:
+                self._remove(waiter, priority)
+            raise
+
+    def release(self, key: K):
+        self._running -= 1
+        running = self._running_per_key[key] - 1
+        if running == 0:
+            del self._running_per_key[key]
+        else:
+            self._running_per_key[key] = running
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: K, priority: bool = False, bounded: bool = True):
+        await self.acquire(key, priority, bounded)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def stats(self):
+        return {
+            'running': self._running,
+            'queued': self._queued,
+            'queued_keys': len(self._queues),
+            'admitted': self._admitted,
+            'rejected': self._rejected,
+            'avg_wait': self._total_wait / self._admitted if self._admitted else 0,
+            'max_wait': self._max_wait,
+        }
@@ -0,0 +1,29 @@
+"""
+Module that re-encodes images into a compact form.
+"""
+
+from io import BytesIO
+from google.genai.types import Blob
+from PIL import Image
+
+
+def downscale_image(blob: Blob, max_side: int = 384, quality: int = 75) -> Blob:
+    """
+    Returns the image as a JPEG of at most `max_side` pixels on its longest side.
+    The blob is returned as is if it can't be decoded or the re-encoded form isn't smaller.
+    """
+    if not blob.data:
+        return blob
+    try:
+        with Image.open(BytesIO(blob.data)) as img:
+            img.thumbnail((max_side, max_side))
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            out = BytesIO()
+            img.save(out, format='JPEG', quality=quality, optimize=True)
+    except (OSError, ValueError):
+        return blob
+
+    if out.tell() >= len(blob.data):
+        return blob
+    return Blob(mime_type='image/jpeg', data=out.getvalue())
@@ -0,0 +1,49 @@
+"""
+Per key locking support for asyncio.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+
+class _Entry:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+class KeyedLock(Generic[K]):
+    """A set of asyncio locks, one per key.
+
+    A lock only exists while it is held or awaited, so idle keys don't pile up in memory.
+    """
+    __entries: dict[K, _Entry]
+
+    def __init__(self) -> None:
+        self.__entries = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def in_use(self, key: K) -> bool:
+        """
+        Whether the lock of the key is held or awaited by someone.
+        """
+        return key in self.__entries
+
+    @asynccontextmanager
+    async def __call__(self, key: K):
+        entry = self.__entries.get(key)
+        if entry is None:
+            entry = self.__entries[key] = _Entry()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self.__entries[key]
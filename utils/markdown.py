@@ -1,40 +1,93 @@
 import re
 
 
-def __is_inside_code_block__(text: str, index: int):
-    code_blocks = re.finditer(r'(^|\s|\\n)```.*?[\s\S]*?```(\\n|\s|$)', text)
-    
-    for code_block in code_blocks:
-        if code_block.start() < index < code_block.end():
-            return True
-        elif index < code_block.start():
-            break
+# a code fence or a paragraph break, the only tokens which matter for splitting
+__TOKENS__ = re.compile(r'```|\n\n+')
+
+def __split_points__(markdown: str, start: int = 0) -> list[int]:
+    """
+    Positions of the paragraph breaks which are not inside a code block, in a single pass.
+
+    An unclosed code block is considered to run until the end of the text.
+    """
+    points: list[int] = []
+    in_code = False
+    for token in __TOKENS__.finditer(markdown, start):
+        if token.group()[0] == '`':
+            in_code = not in_code
+        elif not in_code:
+            points.append(token.start())
+    return points
+
+def __split__(markdown: str, start: int, max_slice_size: int) -> tuple[list[str], list[int]]:
+    """
+    Splits `markdown[start:]` into chunks, returns the chunks along with the start offset of each one.
+    """
+    points = __split_points__(markdown, start)
+    end = len(markdown.rstrip())
+    chunks: list[str] = []
+    offsets: list[int] = []
+    p = 0
 
-    return False
+    while True:
+        # skip the leading whitespaces of the chunk
+        while start < end and markdown[start].isspace():
+            start += 1
+        if end - start <= max_slice_size:
+            break
 
-def __find_split_index__(markdown: str, max_size: int) -> int:
-    sections = re.finditer(r'(\n\n+)', markdown)
-    indices = [0]
-    for section in sections:
-        if section.start() > max_size:
+        # find the last paragraph break which fits in the chunk
+        split_index = -1
+        while p < len(points) and points[p] - start <= max_slice_size:
+            if points[p] > start:
+                split_index = points[p]
+            p += 1
+        if split_index == -1:
             break
-        if not __is_inside_code_block__(markdown, section.start()):
-            indices.append(section.start())
-    return max(indices)
 
-def split_md(markdown: str, max_slice_size: int = 4000):
+        chunks.append(markdown[start:split_index].strip())
+        offsets.append(start)
+        start = split_index
+
+    chunks.append(markdown[start:end].strip())
+    offsets.append(start)
+    return chunks, offsets
 
+def split_md(markdown: str, max_slice_size: int = 4000):
     if len(markdown) <= max_slice_size:
         return [markdown]
-    
-    chunks: list[str] = []
-    while len(markdown) > max_slice_size:
-        split_index = __find_split_index__(markdown, max_slice_size)
-        if split_index == 0:
-            break
-        chunks.append(markdown[:split_index].strip())
-        markdown = markdown[split_index:].strip()
-    
-    chunks.append(markdown.strip())
 
+    chunks, _ = __split__(markdown, 0, max_slice_size)
     return chunks
+
+class MarkdownSplitter():
+    """Splits a growing markdown text incrementally.
+
+    The chunks before the last one never change once the text grows, so they are kept as they are
+    and only the last chunk is split again on every update.
+    """
+    __max_slice_size: int
+    __chunks: list[str]
+    __prefix: str
+
+    def __init__(self, max_slice_size: int = 4000):
+        self.__max_slice_size = max_slice_size
+        self.__chunks = []
+        self.__prefix = ''
+
+    def update(self, markdown: str) -> list[str]:
+        """
+        Returns the chunks of the whole text, which is expected to extend the previous one.
+        """
+        if not markdown.startswith(self.__prefix):
+            # not an extension of the previous text, start over
+            self.__chunks = []
+            self.__prefix = ''
+        if len(markdown) <= self.__max_slice_size:
+            return [markdown]
+
+        chunks, offsets = __split__(markdown, len(self.__prefix), self.__max_slice_size)
+        if len(chunks) > 1:
+            self.__chunks.extend(chunks[:-1])
+            self.__prefix = markdown[:offsets[-1]]
+        return [*self.__chunks, chunks[-1]]
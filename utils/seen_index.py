@@ -0,0 +1,55 @@
+"""
+Time bounded index of recently seen ids.
+"""
+
+import time
+from collections import deque
+
+class SeenIndex:
+    def __init__(self, capacity: int = 10000, ttl: float = 3600):
+        """A compact index of the ids seen recently.
+
+        Parameters
+        -----------
+        capacity: :class:`int`:
+        Max number of ids remembered, the oldest ones are forgotten first.
+
+        ttl: :class:`float`:
+        Seconds for which an id is remembered.
+        """
+        self._capacity = capacity
+        self._ttl = ttl
+        # ring buffer of (id, seen at) in arrival order, the set is for O(1) lookups
+        self._ring: deque[tuple[int, float]] = deque()
+        self._ids: set[int] = set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id: int):
+        return id in self._ids
+
+    def _expire(self, now: float):
+        while self._ring and (len(self._ring) > self._capacity or now - self._ring[0][1] > self._ttl):
+            id, _ = self._ring.popleft()
+            self._ids.discard(id)
+
+    def add(self, id: int, seen_at: float | None = None) -> bool:
+        """
+        Adds the id to the index, returns False if it was already seen.
+        """
+        now = time.time()
+        self._expire(now)
+        if id in self._ids:
+            return False
+        self._ids.add(id)
+        self._ring.append((id, seen_at or now))
+        self._expire(now)
+        return True
+
+    def items(self):
+        """
+        The remembered ids along with the time they were seen.
+        """
+        self._expire(time.time())
+        return list(self._ring)
@@ -0,0 +1,105 @@
+"""
+Time bounded LRU cache for asyncio.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+class _Flight(Generic[V]):
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Task[V]):
+        self.task = task
+        self.waiters = 0
+
+class TTLCache(Generic[K, V]):
+    def __init__(self, capacity: int = 256, ttl: float = 3600):
+        """A LRU cache whose entries expire after a while, concurrent loads of a key share a single call.
+
+        Parameters
+        -----------
+        capacity: :class:`int`:
+        Max number of entries kept, the least recently used ones are dropped first.
+
+        ttl: :class:`float`:
+        Default seconds for which an entry is served.
+        """
+        self._capacity = capacity
+        self._ttl = ttl
+        # key -> (expires at, value), in least recently used order
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._flights: dict[K, _Flight[V]] = {}
+        self._hits = 0
+        self._misses = 0
+        self._shared = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: K, value: V, ttl: float | None = None):
+        self._entries[key] = (time.monotonic() + (self._ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    async def _load(self, key: K, loader: Callable[[], Awaitable[V]], ttl: float | None) -> V:
+        value = await loader()
+        self.put(key, value, ttl)
+        return value
+
+    def _land(self, key: K, flight: _Flight[V]):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def get_or_load(self, key: K, loader: Callable[[], Awaitable[V]], ttl: float | None = None) -> V:
+        """
+        Returns the cached value of the key, or loads it once for all the concurrent callers. Failures are not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            self._hits += 1
+            return value
+
+        flight = self._flights.get(key)
+        if flight is None:
+            self._misses += 1
+            flight = self._flights[key] = _Flight(asyncio.create_task(self._load(key, loader, ttl)))
+            flight.task.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self._shared += 1
+
+        flight.waiters += 1
+        try:
+            # a cancelled caller must not cancel the load of the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # nobody waits for the value anymore
+                self._land(key, flight)
+                flight.task.cancel()
+
+    def stats(self):
+        lookups = self._hits + self._misses + self._shared
+        return {
+            'size': len(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+            'shared': self._shared,
+            'hit_ratio': (self._hits + self._shared) / lookups if lookups else 0,
+        }